@@ -3,7 +3,8 @@
 # abort on errors
 set -e
 
-cp ../data/packed/processed.7z ./src/dist/processed-data.7z
+# copy packed data (it can be read directly with use_packed_data() in processing.py)
+cp ../data/packed/processed.pak ./src/dist/processed-data.pak
 
 # navigate into the build output directory
 cd src/dist
@@ -11,11 +12,24 @@ cd src/dist
 # if you are deploying to a custom domain
 echo 'csc110.hydev.org' > CNAME
 
-git init
-git add -A
-git commit -m 'deploy'
-
 # if you are deploying to https://<USERNAME>.github.io/<REPO>
-git push -f git@github.com:Hykilpikonna/CSC110-Project.git master:gh-pages
+remote=git@github.com:Hykilpikonna/CSC110-Project.git
+
+# the git repo is kept between builds (write_html only syncs the files that changed), but every
+# deploy is still a single commit without history. it's only pushed if its files are different
+# from the deployed ones, so a deploy whose push failed is pushed again by the next run, and files
+# that the remote already has (like an unchanged processed-data.pak) aren't uploaded again.
+[ -d .git ] || git init
+git add -A
+tree=$(git write-tree)
+deployed=$( (git fetch -q --depth 1 "$remote" gh-pages \
+  && git rev-parse 'FETCH_HEAD^{tree}') || true)
+if [ "$deployed" = "$tree" ]; then
+  echo 'Nothing changed, skipping deploy'
+else
+  commit=$(git commit-tree "$tree" -m 'deploy')
+  git update-ref HEAD "$commit"
+  git push -f "$remote" "$commit:refs/heads/gh-pages"
+fi
 
 cd -
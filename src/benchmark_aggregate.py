@@ -0,0 +1,146 @@
+"""CSC110 Fall 2021 Project
+This module is a benchmark of aggregate_user_days in visualization.py, which reduces a user's
+postings to daily totals with grouped array sums. It compares it with a loop over every posting,
+which is how the daily totals were calculated before, on synthetic users, and checks that both
+give the same totals.
+
+Usage:  python benchmark_aggregate.py [-u users] [-t tweets per user] [-r repeats]
+"""
+import argparse
+import random
+import time
+from typing import Optional, Callable, Any
+
+import numpy as np
+from tabulate import tabulate
+
+import python_ta
+import python_ta.contracts
+
+from processing import Posting, PostingArrays
+from visualization import UserDays, aggregate_user_days, POSTINGS_SINCE
+
+
+def synthetic_postings(n: int, rand: random.Random) -> list[Posting]:
+    """
+    Generate the postings of a synthetic user, sorted by date, between 2019 and 2021
+
+    :param n: Number of postings
+    :param rand: Random number generator
+    :return: Postings
+    """
+    start = np.datetime64('2019-06-01T00:00:00').astype(int)
+    end = np.datetime64('2021-12-01T00:00:00').astype(int)
+    times = sorted(rand.randrange(start, end) for _ in range(n))
+    return [Posting(rand.random() < 0.1, int(rand.expovariate(0.01)), rand.random() < 0.3,
+                    str(np.datetime64(t, 's')))
+            for t in times]
+
+
+def to_arrays(postings: list[Posting]) -> PostingArrays:
+    """
+    Convert postings to arrays, like load_tweet_arrays in processing.py
+
+    :param postings: Postings
+    :return: Posting arrays
+    """
+    return PostingArrays(np.array([p.covid_related for p in postings], bool),
+                         np.array([p.popularity for p in postings], np.int64),
+                         np.array([p.repost for p in postings], bool),
+                         np.array([p.date for p in postings], 'datetime64[s]'))
+
+
+def loop_user_days(postings: list[Posting]) -> UserDays:
+    """
+    Calculate the same daily totals as aggregate_user_days by looping over every posting
+
+    :param postings: Postings
+    :return: Daily totals
+    """
+    since = str(POSTINGS_SINCE)
+    totals = {}
+    for p in postings:
+        if p.date <= since:
+            continue
+        day = totals.setdefault(p.date[:10], [0, 0, 0, 0, 0])
+        if p.repost:
+            day[4] += 1
+            continue
+        day[0] += 1
+        day[2] += p.popularity
+        if p.covid_related:
+            day[1] += 1
+            day[3] += p.popularity
+
+    days = sorted(totals)
+    columns = [np.array([totals[d][i] for d in days], np.int64) for i in range(5)]
+    return UserDays(np.array(days, 'datetime64[D]'), *columns)
+
+
+def benchmark(users: int = 200, tweets: int = 2000, repeats: int = 3,
+              seed: int = 42) -> list[list[str]]:
+    """
+    Time the loop and aggregate_user_days on the same synthetic users, and check that they give
+    the same daily totals
+
+    :param users: Number of synthetic users
+    :param tweets: Number of postings of each user
+    :param repeats: Number of times each method is timed (the fastest time is reported)
+    :param seed: Random seed
+    :return: Table rows of [method, seconds, speedup]
+    """
+    rand = random.Random(seed)
+    postings = [synthetic_postings(tweets, rand) for _ in range(users)]
+    arrays = [to_arrays(p) for p in postings]
+
+    for p, a in zip(postings, arrays):
+        expected, actual = loop_user_days(p), aggregate_user_days(a)
+        assert all(np.array_equal(x, y) for x, y in zip(expected, actual))
+
+    def best(f: Callable[[], Any]) -> float:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    loop = best(lambda: [loop_user_days(p) for p in postings])
+    vectorized = best(lambda: [aggregate_user_days(a) for a in arrays])
+    return [['Loop over postings', f'{loop:.3f}', '1.0x'],
+            ['aggregate_user_days', f'{vectorized:.3f}', f'{loop / vectorized:.1f}x']]
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """
+    Run the benchmark from the command line (see the module docstring)
+
+    :param argv: Command line arguments (Default: sys.argv[1:])
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark aggregate_user_days')
+    parser.add_argument('-u', '--users', type=int, default=200, help='Number of users')
+    parser.add_argument('-t', '--tweets', type=int, default=2000,
+                        help='Number of postings of each user')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='Number of times each method is timed')
+    args = parser.parse_args(argv)
+
+    rows = benchmark(args.users, args.tweets, args.repeats)
+    print(f'{args.users} users with {args.tweets} postings each, best of {args.repeats}:')
+    print(tabulate(rows, ['Method', 'Seconds', 'Speedup'], tablefmt='github'))
+
+
+if __name__ == '__main__':
+    main()
+
+    python_ta.contracts.check_all_contracts()
+    python_ta.check_all(config={
+        'extra-imports': ['argparse', 'random', 'time', 'typing', 'numpy', 'tabulate',
+                          'processing', 'visualization'
+                          ],  # the names (strs) of imported modules
+        # the names (strs) of functions that call print/open/input
+        'allowed-io': ['main'],
+        'max-line-length': 100,
+        'disable': ['R1705', 'C0200']
+    }, output='pyta_report.html')
@@ -2,12 +2,21 @@
 This module uses web requests to collect and process other data we are using in our analysis.
 """
 
+import json
+import os
+import shutil
 from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
 
+import numpy as np
 import requests
 import python_ta
 import python_ta.contracts
 
+from constants import DATA_DIR
+from utils import debug
+
 
 @dataclass
 class CasesData:
@@ -46,11 +55,235 @@ def get_covid_cases_us() -> CasesData:
     return data
 
 
+# Base URL of the New York Times COVID-19 data repository
+NYT_DATA_URL = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master'
+
+# Region levels of the NYT data, REGION_LEVELS[level] = (file name, number of region columns).
+# The region columns come right after the date column: "state" for states, and "county,state" for
+# counties. The last two columns are the cumulative cases and deaths.
+REGION_LEVELS = {'states': ('us-states.csv', 1), 'counties': ('us-counties.csv', 2)}
+
+# Directory of the cached regional cases data (see load_covid_cases_regional)
+COVID_CACHE_DIR = f'{DATA_DIR}/cache/covid'
+
+
+@dataclass
+class RegionalCases:
+    """
+    A dataclass that stores the cumulative COVID-19 cases and deaths of every region (state or
+    county) on every day, as (region, day) arrays
+
+    Attributes:
+        - level: Region level ("states" or "counties")
+        - regions: Region names ("Washington" for states, "Snohomish, Washington" for counties)
+        - start: First day of the data ("YYYY-MM-DD")
+        - cases: cases[r, i] = Cumulative cases of regions[r] on the i-th day since start (NaN
+        before the region's first report). The arrays are float64, which is exact for every
+        integer count below 2^53.
+        - deaths: deaths[r, i] = Cumulative deaths of regions[r] on the i-th day since start (NaN
+        if not reported)
+
+    Representation Invariants:
+        - self.level in REGION_LEVELS
+        - self.cases.shape == self.deaths.shape == (len(self.regions), self.cases.shape[1])
+    """
+    level: str
+    regions: list[str]
+    start: str
+    cases: np.ndarray
+    deaths: np.ndarray
+
+    def dates(self) -> list[str]:
+        """
+        Get the date of every day column
+
+        :return: Dates ("YYYY-MM-DD")
+        """
+        return np.datetime_as_string(np.datetime64(self.start, 'D')
+                                     + np.arange(self.cases.shape[1])).tolist()
+
+    def daily(self, column: str = 'cases', n: int = 7) -> np.ndarray:
+        """
+        Get the new cases or deaths on each day, averaged over the last n days like the national
+        rolling averages
+
+        :param column: "cases" or "deaths"
+        :param n: Number of days in the rolling average
+        :return: (region, day) array of daily numbers (0 where nothing is reported)
+        """
+        total = np.nan_to_num(np.asarray(getattr(self, column), float))
+        new = np.diff(total, axis=1, prepend=0)
+        cum = np.concatenate([np.zeros((len(new), 1)), np.cumsum(new, axis=1)], axis=1)
+        start = np.maximum(np.arange(new.shape[1]) + 1 - n, 0)
+        return (cum[:, 1:] - cum[:, start]) / n
+
+    def series(self, region: str, column: str = 'cases', n: int = 7) -> dict[str, float]:
+        """
+        Get the daily numbers of one region in the same format as CasesData
+
+        :param region: Region name
+        :param column: "cases" or "deaths"
+        :param n: Number of days in the rolling average
+        :return: series[date in "YYYY-MM-DD"] = n-day average of new cases or deaths
+        """
+        row = self.regions.index(region)
+        return dict(zip(self.dates(), self.daily(column, n)[row].tolist()))
+
+
+def _parse_cases_lines(lines: list[str], region_columns: int, region_ids: dict[str, int]) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse a chunk of lines of an NYT state or county CSV into arrays
+
+    :param lines: CSV lines (without the header)
+    :param region_columns: Number of region columns after the date column
+    :param region_ids: Region name to id, new regions are added to it
+    :return: Arrays of the day (datetime64[D]), region id, cumulative cases and cumulative deaths
+    of each line
+    """
+    lines = [line for line in lines if line != '']
+    if len(lines) == 0:
+        return np.zeros(0, 'datetime64[D]'), np.zeros(0, np.int32), np.zeros(0), np.zeros(0)
+
+    # Split every field of the chunk at once and take the columns with strides, which is much
+    # faster than splitting line by line (the lines have the same number of fields)
+    width = lines[0].count(',') + 1
+    fields = ','.join(lines).split(',')
+    if len(fields) != width * len(lines):
+        raise ValueError('CSV lines have different numbers of fields')
+    columns = [fields[i::width] for i in range(width)]
+    regions = columns[1] if region_columns == 1 else \
+        [f'{county}, {state}' for county, state in zip(columns[1], columns[2])]
+    ids = [region_ids.setdefault(r, len(region_ids)) for r in regions]
+
+    def numbers(column: list[str]) -> np.ndarray:
+        column = np.array(column)
+        return np.where(column == '', 'nan', column).astype(float)
+
+    return np.array(columns[0], 'datetime64[D]'), np.array(ids, np.int32), \
+        numbers(columns[-2]), numbers(columns[-1])
+
+
+def _read_lines(source: str, chunk_lines: int) -> Iterable[list[str]]:
+    """
+    Stream the lines of a CSV file or URL in chunks, skipping the header
+
+    :param source: Local file path or URL
+    :param chunk_lines: Number of lines in a chunk
+    :return: Generator of line chunks
+    """
+    if source.startswith('http://') or source.startswith('https://'):
+        with requests.get(source, stream=True) as r:
+            r.raise_for_status()
+            lines = (line.decode('utf-8') for line in r.iter_lines(1 << 20))
+            yield from _chunk_lines(lines, chunk_lines)
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            yield from _chunk_lines((line.rstrip('\r\n') for line in f), chunk_lines)
+
+
+def _chunk_lines(lines: Iterable[str], chunk_lines: int) -> Iterable[list[str]]:
+    """
+    Split lines into chunks, skipping the first (header) line
+
+    :param lines: Lines
+    :param chunk_lines: Number of lines in a chunk
+    :return: Generator of line chunks
+    """
+    chunk = []
+    lines = iter(lines)
+    next(lines, None)
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_lines:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def build_covid_cases_regional(level: str = 'states', source: Optional[str] = None,
+                               chunk_lines: int = 1 << 17) -> RegionalCases:
+    """
+    Parse an NYT state or county CSV (hundreds of MB for counties) in streaming chunks into
+    (region, day) arrays, and cache them in COVID_CACHE_DIR/<level> as .npy files. Only the parsed
+    numbers of each chunk are kept until the arrays are built, never the CSV text.
+
+    Preconditions:
+        - level in REGION_LEVELS
+
+    :param level: Region level ("states" or "counties")
+    :param source: Local CSV file or URL (Default: the file in the NYT repository)
+    :param chunk_lines: Number of lines parsed at a time
+    :return: Regional cases data
+    """
+    file, region_columns = REGION_LEVELS[level]
+    source = source or f'{NYT_DATA_URL}/{file}'
+    region_ids = {}
+    chunks = []
+    for lines in _read_lines(source, chunk_lines):
+        chunks.append(_parse_cases_lines(lines, region_columns, region_ids))
+        debug(f'Parsed {sum(len(c[0]) for c in chunks)} lines of {file}.')
+
+    days, ids, cases, deaths = [np.concatenate([c[i] for c in chunks]) for i in range(4)]
+    start = days.min() if len(days) > 0 else np.datetime64('2020-01-21', 'D')
+    n = int((days.max() - start).astype(int)) + 1 if len(days) > 0 else 0
+    day = (days - start).astype(np.int64)
+    data = RegionalCases(level, list(region_ids), str(start),
+                         np.full((len(region_ids), n), np.nan),
+                         np.full((len(region_ids), n), np.nan))
+    data.cases[ids, day] = cases
+    data.deaths[ids, day] = deaths
+
+    # Save to a temporary directory first, so a cache that is being read is never overwritten
+    directory = f'{COVID_CACHE_DIR}/{level}'
+    tmp = directory + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    Path(tmp).mkdir(parents=True)
+    np.save(f'{tmp}/cases.npy', data.cases)
+    np.save(f'{tmp}/deaths.npy', data.deaths)
+    with open(f'{tmp}/meta.json', 'w', encoding='utf-8') as f:
+        json.dump({'source': source, 'start': data.start, 'regions': data.regions}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return data
+
+
+def load_covid_cases_regional(level: str = 'states', source: Optional[str] = None,
+                              refresh: bool = False) -> RegionalCases:
+    """
+    Load the state- or county-level COVID-19 cases data from the cache, with the arrays
+    memory-mapped. The data is downloaded and parsed (see build_covid_cases_regional) if it isn't
+    cached yet, if it was cached from a different source, or if refresh is True.
+
+    Preconditions:
+        - level in REGION_LEVELS
+
+    :param level: Region level ("states" or "counties")
+    :param source: Local CSV file or URL (Default: the file in the NYT repository)
+    :param refresh: Whether to download and parse the data again
+    :return: Regional cases data
+    """
+    directory = f'{COVID_CACHE_DIR}/{level}'
+    source = source or f'{NYT_DATA_URL}/{REGION_LEVELS[level][0]}'
+    if not refresh and os.path.isfile(f'{directory}/meta.json'):
+        with open(f'{directory}/meta.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        cases = np.load(f'{directory}/cases.npy', mmap_mode='r')
+        # Caches saved as float32, which rounds counts above 2^24, are parsed again
+        if meta['source'] == source and cases.dtype == np.float64:
+            return RegionalCases(level, meta['regions'], meta['start'], cases,
+                                 np.load(f'{directory}/deaths.npy', mmap_mode='r'))
+    return build_covid_cases_regional(level, source)
+
+
 if __name__ == '__main__':
     python_ta.contracts.check_all_contracts()
     python_ta.check_all(config={
-        'extra-imports': ['requests', 'dataclasses'],  # the names (strs) of imported modules
-        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'extra-imports': ['json', 'os', 'shutil', 'dataclasses', 'pathlib', 'typing', 'numpy',
+                          'requests', 'constants', 'utils'],  # the names (strs) of imported modules
+        # the names (strs) of functions that call print/open/input
+        'allowed-io': ['_read_lines', 'build_covid_cases_regional', 'load_covid_cases_regional'],
         'max-line-length': 100,
         'disable': ['R1705', 'C0200']
     })
@@ -31,7 +31,13 @@ USER_DIR = f'{DATA_DIR}/twitter/user'
 REPORT_DIR = './report'
 RES_DIR = './resources'
 
-# Debug mode, or developer mode. This affects two things:
-# 1. Whether debug messages are outputted
-# 2. Whether the web server regenerates the HTML page for every request
+# Debug mode, or developer mode. This affects whether debug messages are outputted
 DEBUG = True
+
+# Whether the report page is rendered to HTML in Python (see generate_html in report.py), instead
+# of in the browser
+PRERENDER = True
+
+# Memory bound of the process-wide cache of loaded data files (data_cache in processing.py), in
+# bytes of the estimated memory used by the loaded objects (see estimate_size in utils.py)
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
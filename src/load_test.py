@@ -0,0 +1,231 @@
+"""CSC110 Fall 2021 Project
+This module is a load test of the report website served by serve_report in report.py. It sends
+requests to the page and asset routes from many connections at once, and reports the requests per
+second and latency percentiles of each route.
+
+Usage (with the report server running):  python load_test.py [url] [-c connections] [-d seconds]
+Or start a production server at the url for the test:  python load_test.py [url] --serve
+"""
+import argparse
+import http.client
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from typing import NamedTuple, Optional
+
+import numpy as np
+from tabulate import tabulate
+
+import python_ta
+import python_ta.contracts
+
+
+class LoadResult(NamedTuple):
+    """
+    Result of a load test of one route
+
+    Attributes:
+        - path: Url path of the route
+        - seconds: Duration of the test
+        - latencies: Latency of each successful request in milliseconds
+        - errors: Number of failed requests (connection errors or error statuses)
+        - size: Size of the response body in bytes
+
+    Representation Invariants:
+        - self.seconds > 0
+        - self.errors >= 0
+    """
+    path: str
+    seconds: float
+    latencies: list[float]
+    errors: int
+    size: int
+
+    def requests_per_second(self) -> float:
+        """
+        :return: Successful requests per second
+        """
+        return len(self.latencies) / self.seconds
+
+    def percentiles(self, q: list[float]) -> list[float]:
+        """
+        :param q: Percentiles (0 to 100)
+        :return: Latency percentiles in milliseconds
+        """
+        if not self.latencies:
+            return [float('nan')] * len(q)
+        return np.percentile(self.latencies, q).tolist()
+
+
+def _connect(url: str) -> http.client.HTTPConnection:
+    """
+    Open a keep-alive connection to the server of a url
+
+    :param url: Url
+    :return: Connection
+    """
+    parts = urllib.parse.urlsplit(url)
+    return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+
+
+def _worker(url: str, path: str, deadline: float, latencies: list[float],
+            counters: list[int]) -> None:
+    """
+    Request a path on one connection until the deadline
+
+    :param url: Server url
+    :param path: Url path
+    :param deadline: time.perf_counter() of the end of the test
+    :param latencies: Latencies in milliseconds (appended)
+    :param counters: [Number of failed requests, size of the response body] (updated)
+    :return: None
+    """
+    conn = _connect(url)
+    headers = {'Accept-Encoding': 'gzip, br'}
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status >= 400:
+                counters[0] += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+            counters[1] = len(body)
+        except (OSError, http.client.HTTPException):
+            counters[0] += 1
+            conn.close()
+            conn = _connect(url)
+    conn.close()
+
+
+def load_test(url: str, path: str, connections: int = 8, seconds: float = 5) -> LoadResult:
+    """
+    Load test one route: request it on many connections at once for some time
+
+    :param url: Server url (e.g. "http://localhost:8080")
+    :param path: Url path of the route
+    :param connections: Number of concurrent connections
+    :param seconds: Duration in seconds
+    :return: Result
+    """
+    # Every connection has its own latencies and counters
+    stats = [([], [0, 0]) for _ in range(connections)]
+    start = time.perf_counter()
+    deadline = start + seconds
+    threads = [threading.Thread(target=_worker, args=(url, path, deadline) + s)
+               for s in stats]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return LoadResult(path, time.perf_counter() - start, [x for s in stats for x in s[0]],
+                      sum(s[1][0] for s in stats), max(s[1][1] for s in stats))
+
+
+def find_assets(url: str) -> list[str]:
+    """
+    Find the assets (scripts, stylesheets and images) referenced by the report page
+
+    :param url: Server url
+    :return: Url paths of the assets
+    """
+    conn = _connect(url)
+    conn.request('GET', '/')
+    html = conn.getresponse().read().decode('utf-8')
+    conn.close()
+    paths = re.findall(r'(?:src|href)=\\?"(/?(?:html/)?[^"\\:#]+\.(?:js|css|png))\\?"', html)
+    return list(dict.fromkeys('/' + p.lstrip('/') for p in paths))
+
+
+def report_load_test(url: str, connections: int = 8, seconds: float = 5) -> list[LoadResult]:
+    """
+    Load test the page route, and the first script, stylesheet and image route of the page, and
+    print the results in a table
+
+    :param url: Server url
+    :param connections: Number of concurrent connections
+    :param seconds: Duration of each route's test in seconds
+    :return: Results
+    """
+    assets = find_assets(url)
+    paths = ['/'] + [next(p for p in assets if p.endswith(ext))
+                     for ext in ['.js', '.css', '.png'] if any(p.endswith(ext) for p in assets)]
+
+    results = [load_test(url, p, connections, seconds) for p in paths]
+    table = [[r.path, f'{r.size / 1000:.1f}', f'{r.requests_per_second():.0f}']
+             + [f'{x:.2f}' for x in r.percentiles([50, 90, 99])] + [str(r.errors)]
+             for r in results]
+    print(f'{connections} connections, {seconds}s per route:')
+    print(tabulate(table, ['Route', 'Size (KB)', 'Requests/s', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)',
+                           'Errors'], tablefmt='github'))
+    return results
+
+
+def _wait_for_server(url: str, timeout: float = 60) -> None:
+    """
+    Wait until a server accepts connections
+
+    :param url: Server url
+    :param timeout: Max number of seconds to wait
+    :return: None
+    """
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            find_assets(url)
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """
+    Run the load test from the command line (see the module docstring)
+
+    :param argv: Command line arguments (Default: sys.argv[1:])
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Load test the report website')
+    parser.add_argument('url', nargs='?', default='http://localhost:8080', help='Server url')
+    parser.add_argument('-c', '--connections', type=int, default=8,
+                        help='Number of concurrent connections')
+    parser.add_argument('-d', '--seconds', type=float, default=5,
+                        help='Duration of each route\'s test in seconds')
+    parser.add_argument('--serve', action='store_true',
+                        help='Start the report server in production mode for the test')
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.serve:
+        port = urllib.parse.urlsplit(args.url).port or 80
+        server = subprocess.Popen([sys.executable, '-c', 'from report import serve_report; '
+                                   f'serve_report(production=True, port={port})'])
+    try:
+        _wait_for_server(args.url)
+        report_load_test(args.url, args.connections, args.seconds)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
+
+    python_ta.contracts.check_all_contracts()
+    python_ta.check_all(config={
+        'extra-imports': ['argparse', 'http.client', 're', 'subprocess', 'sys', 'threading',
+                          'time', 'urllib.parse', 'typing', 'numpy', 'tabulate'
+                          ],  # the names (strs) of imported modules
+        # the names (strs) of functions that call print/open/input
+        'allowed-io': ['report_load_test'],
+        'max-line-length': 100,
+        'disable': ['R1705', 'C0200']
+    }, output='pyta_report.html')
@@ -72,6 +72,12 @@ if __name__ == '__main__':
     # (After step C2) Process the downloaded tweets, determine whether they are covid-related
     # process_tweets()
 
+    ####################
+    # Data Visualization - Step V0 (Optional)
+    # Read processed data directly from the packed data (data/packed/processed.pak, created by
+    # pack_data) instead of extracting it to the data directory first
+    # use_packed_data(f'{DATA_DIR}/packed/processed.pak')
+
     ####################
     # Data Visualization - Step V1
     # Generate all visualization reports and graphs
@@ -2,24 +2,38 @@
 Processes data downloaded from the Twitter API. Processing consists of calculating popularity of
 users, creating samples of users, filtering news channels, and processing tweets for file storage.
 """
+import bisect
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import math
+import multiprocessing
 import os
 import random
+import shutil
 import sys
+import tempfile
+import time
 import zipfile
+import zlib
+from array import array
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import NamedTuple
+from typing import NamedTuple, Optional, Generator, Any, Callable, TextIO
 
+import numpy as np
 import requests
 from bs4 import BeautifulSoup
 from py7zr import SevenZipFile
 
 import python_ta
 
-from constants import DATA_DIR, TWEETS_DIR, USER_DIR, RES_DIR
-from utils import read, debug, write, json_stringify
+from constants import DATA_DIR, TWEETS_DIR, USER_DIR, RES_DIR, CACHE_MAX_BYTES
+from utils import read, debug, write, json_stringify, LRUCache, Stats, StatsSketch, estimate_size
 
 
 class ProcessedUser(NamedTuple):
@@ -47,54 +61,492 @@ class ProcessedUser(NamedTuple):
     lang: str
 
 
-def process_users() -> None:
+def _process_user_file(filename: str) -> ProcessedUser:
+    """
+    Read one raw user file downloaded by download_users_start and extract the information defined
+    in the ProcessedUser class.
+
+    :param filename: File name of the user json in <user_dir>/users
+    :return: Processed user
+    """
+    user = json.loads(read(f'{USER_DIR}/users/{filename}'))
+
+    # Get user language (The problem is, most people's lang field are null, so we have to look at
+    # the language of their latest status as well, while they might not have a status field as
+    # well!)
+    lang = user['lang']
+    status_lang = user['status']['lang'] if 'status' in user else None
+    if lang is None:
+        lang = status_lang
+
+    return ProcessedUser(user['screen_name'], user['followers_count'], user['statuses_count'], lang)
+
+
+def _process_user_chunk(args: tuple[int, list[str], str, Optional[int]]) -> tuple[str, int]:
+    """
+    Worker task of process_users. Process one chunk of raw user files, sort them by popularity, and
+    write the sorted run to <run_dir>/<index>.jsonl (one user per line). If top_k is not None, only
+    the top_k most popular users of this chunk are kept in the run.
+
+    :param args: Tuple of (chunk index, file names, run directory, top_k)
+    :return: Path of the written run file, and the number of user files processed
+    """
+    index, filenames, run_dir, top_k = args
+    users = [_process_user_file(f) for f in filenames]
+
+    # Sort by followers count, descending (nlargest is equivalent to a stable sort then a slice,
+    # but it only keeps a heap of k users)
+    if top_k is None:
+        users.sort(key=lambda x: x.popularity, reverse=True)
+    else:
+        users = heapq.nlargest(top_k, users, key=lambda x: x.popularity)
+
+    path = os.path.join(run_dir, f'{index:08d}.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        for u in users:
+            f.write(json_stringify(u) + '\n')
+    return path, len(filenames)
+
+
+def _read_user_run(path: str) -> Generator[ProcessedUser, None, None]:
+    """
+    Stream the users in a sorted run file written by _process_user_chunk
+
+    :param path: Run file path
+    :return: Generator of processed users in the order they are stored
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield ProcessedUser(*json.loads(line))
+
+
+def _user_file_chunks(chunk_size: int) -> Generator[list[str], None, None]:
+    """
+    List the raw user files in chunks, in directory order.
+
+    :param chunk_size: Max number of files in a chunk
+    :return: Generator of file name chunks
+    """
+    chunk = []
+    for filename in os.listdir(f'{USER_DIR}/users'):
+        # Only check json files and ignore macOS dot files
+        if filename.endswith('.json') and not filename.startswith('.'):
+            chunk.append(filename)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _merge_user_runs(top_k: Optional[int], processes: Optional[int],
+                     chunk_size: int) -> Generator[ProcessedUser, None, None]:
+    """
+    Process all raw user files in parallel and merge the sorted runs of every chunk.
+
+    Each worker sorts one chunk and spills it to a temporary run file, then the runs are merged
+    with a k-way heap merge. Only one user per run is held in memory while merging, so memory is
+    bounded by chunk_size * processes instead of the number of users. The merge is stable and the
+    runs are merged in chunk order, so users with the same popularity keep their directory order,
+    which is the same as sorting the whole list at once.
+
+    :param top_k: Only yield the top_k most popular users, or None for all users
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :param chunk_size: Number of user files processed by each worker task
+    :return: Generator of processed users, sorted descending by popularity
+    """
+    with tempfile.TemporaryDirectory(prefix='users-') as run_dir, \
+            multiprocessing.Pool(processes) as pool:
+        tasks = ((i, chunk, run_dir, top_k)
+                 for i, chunk in enumerate(_user_file_chunks(chunk_size)))
+        runs = []
+        loaded = 0
+        for run, count in pool.imap(_process_user_chunk, tasks):
+            runs.append(run)
+            loaded += count
+            debug(f'Loaded {loaded} users.')
+
+        merged = heapq.merge(*[_read_user_run(r) for r in runs],
+                             key=lambda x: x.popularity, reverse=True)
+        yield from itertools.islice(merged, top_k)
+
+
+def process_users(processes: Optional[int] = None, chunk_size: int = 20000) -> None:
     """
     After downloading a wide range of users using download_users_start in raw_collect/twitter.py,
     this function will read the user files, extract only relevant information defined in the
     ProcessedUser class, and rank the users by popularity.
 
-    This function will save the processed user data to <user_dir>/processed/users.json
+    The user files are processed by a pool of workers and merged from sorted runs on disk (see
+    _merge_user_runs), and the result is streamed to the output file, so this works with bounded
+    memory for millions of users.
+
+    This function will save the processed user data to <user_dir>/processed/users.json, and the
+    popularity rank index to <user_dir>/processed/rank-index (see UserRankIndex)
 
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :param chunk_size: Number of user files processed by each worker task
     :return: None
     """
-    users = []
+    file = f'{USER_DIR}/processed/users.json'
+    Path(file).parent.mkdir(parents=True, exist_ok=True)
+
+    # Save data. This writes the same json as json_stringify(users) would, one user at a time.
+    # The rank index columns are collected in compact arrays along the way.
+    hashes, checks = array('Q'), array('Q')
+    popularity, num_postings = array('q'), array('q')
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for i, u in enumerate(_merge_user_runs(None, processes, chunk_size)):
+            if i != 0:
+                f.write(', ')
+            f.write(json_stringify(u))
+            h, c = _username_hash(u.username)
+            hashes.append(h)
+            checks.append(c)
+            popularity.append(u.popularity)
+            num_postings.append(u.num_postings)
+        f.write(']')
+
+    UserRankIndex.build(np.array(hashes, np.uint64), np.array(checks, np.uint64),
+                        np.array(popularity, np.int64), np.array(num_postings, np.int64))\
+        .save(f'{USER_DIR}/processed/rank-index')
+
+
+def find_most_popular_users(k: int, processes: Optional[int] = None,
+                            chunk_size: int = 20000) -> list[ProcessedUser]:
+    """
+    Find the k most popular users directly from the raw user files, without processing and storing
+    every user. Each worker only keeps a heap of its k most popular users.
 
-    # Loop through all the files
-    for filename in os.listdir(f'{USER_DIR}/users'):
-        # Only check json files and ignore macOS dot files
-        if filename.endswith('.json') and not filename.startswith('.'):
-            # Read
-            user = json.loads(read(f'{USER_DIR}/users/{filename}'))
+    Preconditions:
+        - k > 0
+
+    :param k: Number of users
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :param chunk_size: Number of user files processed by each worker task
+    :return: The k most popular users, sorted descending by popularity (same as the first k users
+    of process_users)
+    """
+    return list(_merge_user_runs(k, processes, chunk_size))
 
-            # Get user language (The problem is, most people's lang field are null, so we have to
-            # look at the language of their latest status as well, while they might not have a
-            # status field as well!)
-            lang = user['lang']
-            status_lang = user['status']['lang'] if 'status' in user else None
-            if lang is None:
-                lang = status_lang
 
-            users.append(ProcessedUser(user['screen_name'], user['followers_count'],
-                                       user['statuses_count'], lang))
+def _file_signature(file: str) -> Optional[tuple[int, int]]:
+    """
+    Get a cheap signature of a data file that changes whenever the file is rewritten. When reading
+    from packed data (see use_packed_data), this is the packed data file's modified time and the
+    size of the member.
+
+    :param file: File path
+    :return: (Modified time in ns, size), or None if the file doesn't exist
+    """
+    if _packed_data is not None:
+        member = _data_member(file)
+        if member not in _packed_data:
+            return None
+        return os.stat(_packed_data.file).st_mtime_ns, _packed_data.members[member][1]
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
 
-            # Log progress
-            if len(users) % 2000 == 0:
-                debug(f'Loaded {len(users)} users.')
+# The packed data that processed data is read from, or None to read from DATA_DIR
+_packed_data: Optional['PackedData'] = None
 
-    # Sort by followers count, descending
-    users.sort(key=lambda x: x.popularity, reverse=True)
+# Process-wide cache of loaded data files, shared by every loader in this module
+data_cache = LRUCache(CACHE_MAX_BYTES)
 
-    # Save data
-    write(f'{USER_DIR}/processed/users.json', json_stringify(users))
+
+def _load_cached(file: str, loader: Callable[[], Any], kind: str = '') -> Any:
+    """
+    Load a data file through data_cache. The cached object is reused until the file's signature
+    changes, and the estimated memory used by the loaded object is used as the size of the entry.
+
+    :param file: Data file path
+    :param loader: Function that loads the file
+    :param kind: Name of the loaded representation, for files that are loaded in more than one way
+    :return: Loaded object (shared, the caller must not modify it)
+    """
+    sig = _file_signature(file)
+    if sig is None:
+        return loader()
+    return data_cache.get((file, kind), sig, loader, estimate_size)
 
 
 def load_users() -> list[ProcessedUser]:
     """
-    Load processed user data after process_users
+    Load processed user data after process_users. The parsed file is cached in memory until
+    users.json changes.
 
     :return: List of processed users, sorted descending by popularity.
     """
-    return [ProcessedUser(*u) for u in json.loads(read(f'{USER_DIR}/processed/users.json'))]
+    file = f'{USER_DIR}/processed/users.json'
+    return list(_load_cached(file, lambda: [ProcessedUser(*u)
+                                            for u in json.loads(read_data(file))]))
+
+
+def iter_users(chunk_size: int = 1 << 20) -> Generator[ProcessedUser, None, None]:
+    """
+    Stream processed users from users.json one at a time, reading the file in chunks instead of
+    parsing the whole json array at once.
+
+    :param chunk_size: Number of characters read at a time
+    :return: Generator of processed users, sorted descending by popularity
+    """
+    decoder = json.JSONDecoder()
+    with open_data(f'{USER_DIR}/processed/users.json') as f:
+        buf = f.read(chunk_size).lstrip()[1:]
+        pos = 0
+        while True:
+            # Skip separators between users
+            while pos < len(buf) and buf[pos] in ', \t\r\n':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+
+            # Every user is a json array, so a user at the end of the buffer can only be decoded
+            # once its closing bracket is read
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                more = f.read(chunk_size)
+                if more == '':
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield ProcessedUser(*obj)
+
+
+def _username_hash(username: str) -> tuple[int, int]:
+    """
+    Stable 128-bit hash of a username, split into the 64-bit key of UserRankIndex (0 is reserved
+    for empty slots, so the lowest bit is always set) and a 64-bit check value that is compared
+    on lookup, so that a username whose key collides with a ranked user's isn't mistaken for them
+
+    :param username: Username
+    :return: (Key, check value)
+    """
+    digest = hashlib.blake2b(username.encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little') | 1, int.from_bytes(digest[8:], 'little')
+
+
+RANK_INDEX_ARRAYS = ['keys', 'checks', 'ranks', 'popularity', 'num_postings']
+
+
+class UserRankIndex:
+    """
+    Persisted popularity ranking of the processed users, built alongside users.json so that ranks
+    can be looked up without loading and scanning the users list.
+
+    The index is an open-addressing hash table (linear probing) from username hash to rank, plus
+    popularity and number of postings in rank order. A slot whose key matches but whose check
+    value doesn't belongs to a different user, so probing continues past it. Every array is stored
+    as a .npy file in <user_dir>/processed/rank-index and memory-mapped when loaded.
+
+    Attributes:
+        - keys: Hash table slots, keys[slot] = Key of _username_hash(username), or 0 for an empty
+          slot
+        - checks: checks[slot] = Check value of _username_hash(username) of the user in that slot
+        - ranks: ranks[slot] = Popularity rank (starting from 1) of the user in that slot
+        - popularity: popularity[rank - 1] = Popularity of the user with that rank
+        - num_postings: num_postings[rank - 1] = Number of postings of the user with that rank
+
+    Representation Invariants:
+        - len(self.keys) == len(self.checks) == len(self.ranks)
+        - len(self.keys) is a power of two and len(self.keys) > len(self.popularity)
+        - len(self.popularity) == len(self.num_postings)
+    """
+    keys: np.ndarray
+    checks: np.ndarray
+    ranks: np.ndarray
+    popularity: np.ndarray
+    num_postings: np.ndarray
+
+    def __init__(self, keys: np.ndarray, checks: np.ndarray, ranks: np.ndarray,
+                 popularity: np.ndarray, num_postings: np.ndarray) -> None:
+        self.keys = keys
+        self.checks = checks
+        self.ranks = ranks
+        self.popularity = popularity
+        self.num_postings = num_postings
+
+    @staticmethod
+    def build(hashes: np.ndarray, checks: np.ndarray, popularity: np.ndarray,
+              num_postings: np.ndarray) -> 'UserRankIndex':
+        """
+        Build the index from users in ranking order
+
+        :param hashes: hashes[i] = Key of _username_hash of the user ranked i + 1
+        :param checks: checks[i] = Check value of _username_hash of the user ranked i + 1
+        :param popularity: popularity[i] = Popularity of the user ranked i + 1
+        :param num_postings: num_postings[i] = Number of postings of the user ranked i + 1
+        :return: Rank index
+        """
+        n = len(hashes)
+        # Keep the table at most half full so that probe sequences stay short
+        capacity = 1 << max(4, (2 * n - 1).bit_length())
+        mask = np.uint64(capacity - 1)
+        keys = np.zeros(capacity, np.uint64)
+        slot_checks = np.zeros(capacity, np.uint64)
+        ranks = np.zeros(capacity, np.int64)
+
+        # Insert every key in vectorized rounds. In each round, every pending key whose current
+        # slot is empty claims it (the best ranked key wins ties), and the others move to the next
+        # slot, which is the same layout as inserting the keys one by one in ranking order.
+        slot = hashes & mask
+        pending = np.arange(n)
+        while len(pending) > 0:
+            s = slot[pending]
+            free = keys[s] == 0
+            _, first = np.unique(s[free], return_index=True)
+            won = pending[free][first]
+            keys[slot[won]] = hashes[won]
+            slot_checks[slot[won]] = checks[won]
+            ranks[slot[won]] = won + 1
+
+            placed = np.zeros(n, bool)
+            placed[won] = True
+            pending = pending[~placed[pending]]
+            slot[pending] = (slot[pending] + np.uint64(1)) & mask
+
+        return UserRankIndex(keys, slot_checks, ranks, popularity, num_postings)
+
+    def save(self, directory: str) -> None:
+        """
+        Save the index as .npy files. The files are written to a temporary directory first, so an
+        index that is memory-mapped is never partly overwritten.
+
+        :param directory: Index directory
+        :return: None
+        """
+        tmp = directory + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        Path(tmp).mkdir(parents=True)
+        for name in RANK_INDEX_ARRAYS:
+            np.save(os.path.join(tmp, f'{name}.npy'), getattr(self, name))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp, directory)
+
+    @staticmethod
+    def load(directory: str) -> 'UserRankIndex':
+        """
+        Load a saved index with every array memory-mapped
+
+        :param directory: Index directory
+        :return: Rank index
+        """
+        return UserRankIndex(*[np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                               for name in RANK_INDEX_ARRAYS])
+
+    def __len__(self) -> int:
+        return len(self.popularity)
+
+    def rank(self, username: str) -> int:
+        """
+        Get a user's popularity ranking
+
+        :param username: Username
+        :return: User's popularity ranking (starting from 1), or -1 if the user isn't ranked
+        """
+        h, c = _username_hash(username)
+        mask = len(self.keys) - 1
+        slot = h & mask
+        while True:
+            key = int(self.keys[slot])
+            if key == h and int(self.checks[slot]) == c:
+                return int(self.ranks[slot])
+            if key == 0:
+                return -1
+            slot = (slot + 1) & mask
+
+    def ranks_of(self, usernames: list[str]) -> np.ndarray:
+        """
+        Get the popularity rankings of many users at once
+
+        :param usernames: Usernames
+        :return: Array of rankings in the same order, -1 for users that aren't ranked
+        """
+        hashes, checks = np.array([_username_hash(u) for u in usernames], np.uint64)\
+            .reshape(-1, 2).T.copy()
+        mask = np.uint64(len(self.keys) - 1)
+        out = np.full(len(hashes), -1, np.int64)
+
+        # Probe every pending username in lock step until it's found or hits an empty slot
+        slot = hashes & mask
+        pending = np.arange(len(hashes))
+        while len(pending) > 0:
+            keys = self.keys[slot[pending]]
+            found = (keys == hashes[pending]) & (self.checks[slot[pending]] == checks[pending])
+            out[pending[found]] = self.ranks[slot[pending[found]]]
+            pending = pending[~found & (keys != 0)]
+            slot[pending] = (slot[pending] + np.uint64(1)) & mask
+        return out
+
+    def percentile(self, username: str) -> float:
+        """
+        Get the percentage of ranked users that are less popular than this user
+
+        :param username: Username
+        :return: Percentile between 0 and 100, or -1 if the user isn't ranked
+        """
+        r = self.rank(username)
+        if r == -1:
+            return -1
+        return 100 * (len(self) - r) / len(self)
+
+    def popularity_at_percentile(self, q: float) -> int:
+        """
+        Get the popularity of the user at the q-th percentile (the popularity that q% of the users
+        are below). Since the popularity array is sorted, this is a direct lookup.
+
+        Preconditions:
+            - 0 <= q <= 100
+            - len(self) > 0
+
+        :param q: Percentile
+        :return: Popularity
+        """
+        return int(self.popularity[round((1 - q / 100) * (len(self) - 1))])
+
+
+def build_rank_index() -> UserRankIndex:
+    """
+    Build the popularity rank index from users.json and save it to <user_dir>/processed/rank-index.
+    This is called by process_users, so it only needs to be called manually for users.json files
+    processed before the index existed.
+
+    :return: Rank index
+    """
+    users = load_users()
+    hashes = np.array([_username_hash(u.username) for u in users], np.uint64).reshape(-1, 2)
+    index = UserRankIndex.build(hashes[:, 0].copy(), hashes[:, 1].copy(),
+                                np.array([u.popularity for u in users], np.int64),
+                                np.array([u.num_postings for u in users], np.int64))
+    index.save(f'{USER_DIR}/processed/rank-index')
+    return index
+
+
+def load_rank_index() -> UserRankIndex:
+    """
+    Load the popularity rank index. The index is rebuilt if it is missing or older than users.json,
+    and it is cached in memory until it changes.
+
+    :return: Rank index
+    """
+    directory = f'{USER_DIR}/processed/rank-index'
+    if _packed_data is not None:
+        return _load_cached(f'{directory}/checks.npy', lambda: UserRankIndex(*[
+            np.load(io.BytesIO(_packed_data.read_bytes(_data_member(f'{directory}/{name}.npy'))))
+            for name in RANK_INDEX_ARRAYS]))
+
+    users_sig = _file_signature(f'{USER_DIR}/processed/users.json')
+    # Indexes saved before the check values were added are rebuilt
+    index_sig = _file_signature(f'{directory}/checks.npy')
+    if index_sig is None or (users_sig is not None and index_sig[0] < users_sig[0]):
+        build_rank_index()
+    return _load_cached(f'{directory}/checks.npy', lambda: UserRankIndex.load(directory))
 
 
 def get_user_popularity_ranking(user: str) -> int:
@@ -104,11 +556,59 @@ def get_user_popularity_ranking(user: str) -> int:
     :param user: Username
     :return: User's popularity ranking
     """
-    pop = load_users()
-    for i in range(len(pop)):
-        if pop[i].username == user:
-            return i + 1
-    return -1
+    return load_rank_index().rank(user)
+
+
+def get_user_popularity_rankings(users: list[str]) -> list[int]:
+    """
+    Get the popularity rankings of many users at once.
+
+    :param users: Usernames
+    :return: Popularity rankings in the same order, -1 for users that aren't ranked
+    """
+    return load_rank_index().ranks_of(users).tolist()
+
+
+def _sketch_rank_index(args: tuple[str, int, int]) -> StatsSketch:
+    """
+    Worker task of get_population_statistics. Sketch a range of a column of the rank index.
+
+    :param args: Tuple of (column name, start rank index, end rank index)
+    :return: Statistics sketch of the range
+    """
+    column, start, end = args
+    sketch = StatsSketch()
+    values = getattr(load_rank_index(), column)
+    for i in range(start, end, 1 << 16):
+        sketch.update(values[i:min(i + (1 << 16), end)])
+    return sketch
+
+
+def get_population_statistics(column: str = 'popularity', processes: Optional[int] = None,
+                              chunk_size: int = 1 << 20) -> Stats:
+    """
+    Calculate statistics of every processed user (not only the sampled users) in one pass over the
+    memory-mapped rank index. Ranges of users are sketched by a pool of workers and the sketches
+    are merged, so memory is bounded however many users there are. The quantiles are approximate
+    (see StatsSketch).
+
+    Preconditions:
+        - column in {'popularity', 'num_postings'}
+        - len(load_rank_index()) > 1
+
+    :param column: Statistic of the users, popularity (followers) or num_postings
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :param chunk_size: Number of users sketched by each worker task
+    :return: Statistics
+    """
+    n = len(load_rank_index())
+    tasks = [(column, i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+    with multiprocessing.Pool(min(processes or os.cpu_count(), len(tasks)),
+                              use_packed_data, (packed_data_file(),)) as pool:
+        sketches = pool.map(_sketch_rank_index, tasks)
+    for sketch in sketches[1:]:
+        sketches[0].merge(sketch)
+    return sketches[0].stats()
 
 
 @dataclass()
@@ -120,16 +620,116 @@ class UserSample:
         - most_popular: Our sample of the most popular users on Twitter
         - random: Our sample of random users on Twitter
         - english_news: Our sample of news media accounts on Twitter
+        - seed: The random seed used to select the random sample (None for older samples)
+        - stratify: How the random sample is stratified ('lang', 'followers', or None)
 
     Representation Invariants:
         - all(news != '' for news in self.english_news)
+        - self.stratify in {None, 'lang', 'followers'}
     """
     most_popular: list[ProcessedUser]
     random: list[ProcessedUser]
     english_news: list[str]
+    seed: Optional[int] = None
+    stratify: Optional[str] = None
+
+
+# Languages we know how to identify COVID-related posts in
+SAMPLE_LANGUAGES = ['en', 'zh', 'ja']
+
+# Lower bounds of the follower bands used by select_user_sample(stratify='followers')
+FOLLOWER_BANDS = [0, 1000, 10000, 100000]
+
+
+def user_stratum(user: ProcessedUser, stratify: str) -> str:
+    """
+    Get the stratum a user belongs to
+
+    Preconditions:
+        - stratify in {'lang', 'followers'}
+        - stratify != 'lang' or any(lang in user.lang for lang in SAMPLE_LANGUAGES)
+
+    :param user: User
+    :param stratify: 'lang' for the first sample language in the user's language code, or
+    'followers' for the user's follower band
+    :return: Stratum name
+    """
+    if stratify == 'lang':
+        return next(lang for lang in SAMPLE_LANGUAGES if lang in user.lang)
+    band = bisect.bisect_right(FOLLOWER_BANDS, user.popularity) - 1
+    return f'{FOLLOWER_BANDS[band]}+'
 
 
-def select_user_sample() -> None:
+class ReservoirSampler:
+    """
+    Uniform random sampling from a stream of unknown length in constant memory (Algorithm R),
+    optionally stratified. Each stratum keeps its own reservoir, and the final sample is allocated
+    to the strata in proportion to how many users were seen in each of them.
+
+    Attributes:
+        - size: Number of items to sample
+        - rng: Random number generator
+        - reservoirs: reservoirs[stratum] = Uniform sample of up to size items in that stratum
+        - counts: counts[stratum] = Number of items seen in that stratum
+
+    Representation Invariants:
+        - self.size > 0
+        - all(len(self.reservoirs[s]) == min(self.size, self.counts[s]) for s in self.counts)
+    """
+    size: int
+    rng: random.Random
+    reservoirs: dict[str, list]
+    counts: dict[str, int]
+
+    def __init__(self, size: int, rng: random.Random) -> None:
+        self.size = size
+        self.rng = rng
+        self.reservoirs = {}
+        self.counts = {}
+
+    def add(self, item: Any, stratum: str = '') -> None:
+        """
+        Offer an item to the sampler
+
+        :param item: Item
+        :param stratum: Stratum of the item
+        :return: None
+        """
+        if stratum not in self.counts:
+            self.reservoirs[stratum] = []
+            self.counts[stratum] = 0
+        self.counts[stratum] += 1
+        reservoir = self.reservoirs[stratum]
+        if len(reservoir) < self.size:
+            reservoir.append(item)
+        else:
+            j = self.rng.randrange(self.counts[stratum])
+            if j < self.size:
+                reservoir[j] = item
+
+    def sample(self) -> list:
+        """
+        Draw the final sample, allocating it proportionally to the strata (largest remainder)
+
+        :return: Sample of self.size items
+        """
+        total = sum(self.counts.values())
+        if total < self.size:
+            raise ValueError(f'Sample larger than population ({self.size} > {total})')
+
+        strata = sorted(self.counts)
+        quotas = {s: self.size * self.counts[s] / total for s in strata}
+        alloc = {s: math.floor(quotas[s]) for s in strata}
+        by_remainder = sorted(strata, key=lambda x: quotas[x] - alloc[x], reverse=True)
+        for s in by_remainder[:self.size - sum(alloc.values())]:
+            alloc[s] += 1
+
+        # A uniform sample of a uniform reservoir is still a uniform sample of the stratum
+        return [item for s in strata for item in self.rng.sample(self.reservoirs[s], alloc[s])]
+
+
+def select_user_sample(seed: Optional[int] = None, stratify: Optional[str] = None,
+                       size: int = 500) -> None:
     """
     Select our sample of the 500 most popular users and 500 random users who meet the criteria. The
     criteria we use is that the user must have at least 150 followers, and must have a number of
@@ -137,8 +737,19 @@ def select_user_sample() -> None:
     enough followers for interaction might not reveal useful information. We also filter based on
     language, because we only know how to identify COVID-related posts in a few languages.
 
+    This makes one pass over the processed users, keeping a heap of the most popular users and a
+    reservoir of random users, so it uses constant memory no matter how many users we crawled. The
+    random sample can be stratified by language or follower band, and the seed is recorded in the
+    sample so that it can be reproduced.
+
     The result will be stored in <user_dir>/processed/sample.json
 
+    Preconditions:
+        - stratify in {None, 'lang', 'followers'}
+
+    :param seed: Random seed (Default: a new random seed, which will be recorded)
+    :param stratify: Stratify the random sample by 'lang' or 'followers', or None
+    :param size: Number of users in the most popular sample and in the random sample
     :return: None
     """
     file = f'{USER_DIR}/processed/sample.json'
@@ -149,26 +760,39 @@ def select_user_sample() -> None:
               f'sample, please delete the existing sample file.')
         return
 
-    # Load users
-    users = load_users()
-
-    # Filter by language first
-    users = [u for u in users if u.lang is not None
-             and any(lang in u.lang for lang in {'en', 'zh', 'ja'})]
-
-    # Find most popular, and exclude them from the random sample
-    most_popular = users[:500]
-    users = users[500:]
-
-    # Filter by criteria
-    filtered = {u for u in users if 150 < u.popularity and 1000 < u.num_postings < 3250}
-    debug(f'There are {len(filtered)} users who meets the criteria.')
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+    sampler = ReservoirSampler(size, random.Random(seed))
+
+    # Heap of (popularity, -index, user) for the most popular users. When a user is pushed out of
+    # the heap, they're no longer in the most popular sample, so they can enter the random sample.
+    most_popular = []
+    filtered = 0
+    for i, u in enumerate(iter_users()):
+        # Filter by language first
+        if u.lang is None or not any(lang in u.lang for lang in SAMPLE_LANGUAGES):
+            continue
+
+        # Find most popular, and exclude them from the random sample
+        if len(most_popular) < size:
+            heapq.heappush(most_popular, (u.popularity, -i, u))
+            continue
+        u = heapq.heappushpop(most_popular, (u.popularity, -i, u))[2]
+
+        # Filter by criteria
+        if 150 < u.popularity and 1000 < u.num_postings < 3250:
+            filtered += 1
+            sampler.add(u, user_stratum(u, stratify) if stratify is not None else '')
+    debug(f'There are {filtered} users who meets the criteria.')
 
     # Sample
-    sample = random.sample(filtered, 500)
+    most_popular = [u for _, _, u in sorted(most_popular, reverse=True)]
+    sample = sampler.sample()
+    debug(f'Selected the random sample with seed {seed}.')
 
     # Save
-    write(file, json_stringify(UserSample(most_popular, sample, get_english_news_channels())))
+    write(file, json_stringify(UserSample(most_popular, sample, get_english_news_channels(),
+                                          seed, stratify)))
 
 
 def get_english_news_channels() -> list[str]:
@@ -225,14 +849,15 @@ def filter_news_channels() -> None:
 
 def load_user_sample() -> UserSample:
     """
-    Load the selected sample
+    Load the selected sample. The parsed file is cached in memory until sample.json changes.
 
     :return: None
     """
-    j = json.loads(read(f'{USER_DIR}/processed/sample.json'))
+    file = f'{USER_DIR}/processed/sample.json'
+    j = _load_cached(file, lambda: json.loads(read_data(file)))
     return UserSample([ProcessedUser(*u) for u in j['most_popular']],
                       [ProcessedUser(*u) for u in j['random']],
-                      j['english_news'])
+                      list(j['english_news']), j.get('seed'), j.get('stratify'))
 
 
 class Posting(NamedTuple):
@@ -291,13 +916,64 @@ def process_tweets() -> None:
 
 def load_tweets(username: str) -> list[Posting]:
     """
-    Load tweets for a specific user
+    Load tweets for a specific user. The parsed tweets are kept in data_cache until the file
+    changes, so users that appear in more than one sample are only parsed once.
 
     :param username: User's screen name
     :return: User's processed tweets
     """
-    return [Posting(*p) for p in json.loads(read(
-        os.path.join(TWEETS_DIR, f'processed/{username}.json')))]
+    file = os.path.join(TWEETS_DIR, f'processed/{username}.json')
+    return list(_load_cached(file, lambda: [Posting(*p) for p in json.loads(read_data(file))]))
+
+
+class PostingArrays(NamedTuple):
+    """
+    The columns of a user's processed postings as numpy arrays, for vectorized calculations.
+
+    Attributes:
+        - covid_related: covid_related[i] = Whether the i-th post is covid-related
+        - popularity: popularity[i] = Popularity of the i-th post
+        - repost: repost[i] = Whether the i-th post is a repost
+        - time: time[i] = Posting date and time of the i-th post (datetime64[s])
+
+    Representation Invariants:
+        - len(self.covid_related) == len(self.popularity) == len(self.repost) == len(self.time)
+    """
+    covid_related: np.ndarray
+    popularity: np.ndarray
+    repost: np.ndarray
+    time: np.ndarray
+
+
+def tweets_signature(username: str) -> Optional[tuple[int, int]]:
+    """
+    Get the signature of a user's processed tweets file, which changes whenever the file changes
+
+    :param username: User's screen name
+    :return: (Modified time in ns, size), or None if the file doesn't exist
+    """
+    return _file_signature(os.path.join(TWEETS_DIR, f'processed/{username}.json'))
+
+
+def load_tweet_arrays(username: str) -> PostingArrays:
+    """
+    Load tweets for a specific user as arrays. Like load_tweets, the result is kept in data_cache.
+
+    :param username: User's screen name
+    :return: User's processed tweets as arrays (shared, the caller must not modify them)
+    """
+    def load() -> PostingArrays:
+        raw = json.loads(read_data(file))
+        if len(raw) == 0:
+            return PostingArrays(np.zeros(0, bool), np.zeros(0, np.int64), np.zeros(0, bool),
+                                 np.zeros(0, 'datetime64[s]'))
+        covid_related, popularity, repost, date = zip(*raw)
+        # numpy parses ISO dates in C, which is much faster than parsing them one by one
+        return PostingArrays(np.array(covid_related, bool), np.array(popularity, np.int64),
+                             np.array(repost, bool), np.array(date, 'datetime64[s]'))
+
+    file = os.path.join(TWEETS_DIR, f'processed/{username}.json')
+    return _load_cached(file, load, 'arrays')
 
 
 def is_covid_related(text: str) -> bool:
@@ -326,32 +1002,368 @@ def is_covid_related(text: str) -> bool:
     return any(k in text.lower() for k in keywords)
 
 
-def pack_data() -> None:
+# Processed data directories that are packed by pack_data, relative to DATA_DIR
+PROCESSED_DIRS = ['twitter/user/meta', 'twitter/user/processed', 'twitter/user-tweets/processed']
+
+
+def _pack_shard(args: tuple[str, list[str], str]) -> tuple[str, int, float]:
+    """
+    Worker task of pack_processed_data. Compress one shard of processed data files into a 7z
+    archive, with paths relative to DATA_DIR so that extracting every shard into DATA_DIR restores
+    the processed data.
+
+    :param args: Tuple of (archive path, file paths relative to DATA_DIR, shard name)
+    :return: Shard name, packed size in bytes, and time taken in seconds
+    """
+    archive, files, name = args
+    start = time.perf_counter()
+    with SevenZipFile(archive + '.tmp', 'w') as z:
+        z: SevenZipFile = z
+        for f in files:
+            z.write(os.path.join(DATA_DIR, f), f)
+    os.replace(archive + '.tmp', archive)
+    return name, os.path.getsize(archive), time.perf_counter() - start
+
+
+# Target number of files in a data shard
+SHARD_FILES = 64
+
+
+def _shard_count(num_files: int, old_count: Optional[int]) -> int:
+    """
+    Choose the number of shards of a directory. The count is stored in the pack manifest and kept
+    across runs, since changing it moves almost every file to a different shard and repacks the
+    whole directory. It's only chosen again (as a power of two that keeps around SHARD_FILES files
+    in a shard) the first time a directory is packed, or once its shards grow to over four times
+    the target size.
+
+    >>> _shard_count(1000, None)
+    16
+    >>> _shard_count(1100, 16)
+    16
+    >>> _shard_count(5000, 16)
+    128
+
+    :param num_files: Number of files in the directory
+    :param old_count: Number of shards of the directory in the last run, or None
+    :return: Number of shards
+    """
+    if old_count is not None and num_files <= old_count * SHARD_FILES * 4:
+        return old_count
+    return 1 << max(0, math.ceil(math.log2(max(1, num_files) / SHARD_FILES)))
+
+
+def _shard_files(directory: str, files: list[str], n: int) -> dict[int, list[str]]:
+    """
+    Assign the files in a directory to shards by a stable hash of the file name, so that adding or
+    changing a file only affects the shard it belongs to.
+
+    :param directory: Directory relative to DATA_DIR
+    :param files: Sorted file paths relative to the directory
+    :param n: Number of shards (see _shard_count)
+    :return: shards[i] = Paths relative to DATA_DIR of the files in the i-th shard
+    """
+    shards = {}
+    for f in files:
+        shards.setdefault(zlib.crc32(f.encode('utf-8')) % n, []).append(f'{directory}/{f}')
+    return shards
+
+
+def pack_processed_data(packed_dir: str, processes: Optional[int] = None) -> None:
+    """
+    Pack processed data into sharded 7z archives in <packed_dir>/processed, and bundle them into
+    <packed_dir>/processed.pak (see bundle_processed_data).
+
+    Packing is incremental: <packed_dir>/processed/manifest.json records the number of shards of
+    each directory and the size and modified time of every file in each shard, and only the shards
+    whose files changed are compressed again. The
+    changed shards are compressed in parallel by a pool of workers. Extracting every shard into
+    DATA_DIR restores the processed data.
+
+    :param packed_dir: Packed data directory
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :return: None
+    """
+    out_dir = f'{packed_dir}/processed'
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    manifest_file = f'{out_dir}/manifest.json'
+    old_manifest = json.loads(read(manifest_file)) if os.path.isfile(manifest_file) else {}
+    old = old_manifest.get('shards', {})
+    old_counts = old_manifest.get('shard_counts', {})
+
+    # Find shards that need to be packed
+    shards = {}
+    shard_counts = {}
+    tasks = []
+    for d in PROCESSED_DIRS:
+        root = os.path.join(DATA_DIR, d)
+        files = sorted(os.path.relpath(os.path.join(r, f), root).replace('\\', '/')
+                       for r, _, fs in os.walk(root) for f in fs if not f.startswith('.'))
+        shard_counts[d] = _shard_count(len(files), old_counts.get(d))
+        for i, paths in sorted(_shard_files(d, files, shard_counts[d]).items()):
+            name = f'{d.replace("/", "-")}-{i:04d}.7z'
+            sigs = {}
+            for f in paths:
+                st = os.stat(os.path.join(DATA_DIR, f))
+                sigs[f] = [st.st_size, st.st_mtime_ns]
+            shards[name] = {'dir': d, 'files': sigs, 'size': 0}
+
+            if name in old and old[name]['files'] == sigs and os.path.isfile(f'{out_dir}/{name}'):
+                shards[name]['size'] = old[name]['size']
+            else:
+                tasks.append((f'{out_dir}/{name}', paths, name))
+
+    # Pack changed shards in parallel
+    times = {}
+    if len(tasks) > 0:
+        debug(f'Packing {len(tasks)} of {len(shards)} data shards...')
+        start = time.perf_counter()
+        with multiprocessing.Pool(processes) as pool:
+            for name, size, seconds in pool.imap_unordered(_pack_shard, tasks):
+                shards[name]['size'] = size
+                times[name] = seconds
+        debug(f'Packed in {time.perf_counter() - start:.1f}s')
+
+    # Remove shards that don't exist anymore
+    for name in set(old) - set(shards):
+        if os.path.isfile(f'{out_dir}/{name}'):
+            os.remove(f'{out_dir}/{name}')
+
+    write(manifest_file, json_stringify({'shard_counts': shard_counts, 'shards': shards}, indent=1))
+    bundle_processed_data(packed_dir)
+
+    # Report
+    for d in PROCESSED_DIRS:
+        ds = [n for n in shards if shards[n]['dir'] == d]
+        raw = sum(sig[0] for n in ds for sig in shards[n]['files'].values())
+        packed = sum(shards[n]['size'] for n in ds)
+        packed_count = len([n for n in ds if n in times])
+        debug(f'- {d}: {packed_count} of {len(ds)} shards packed in '
+              f'{sum(times.get(n, 0) for n in ds):.1f}s of worker time, '
+              f'{raw / 1e6:.1f} MB -> {packed / 1e6:.1f} MB '
+              f'(ratio {packed / raw if raw > 0 else 1:.3f})')
+
+
+# Magic bytes at the start of a processed data bundle
+PACK_MAGIC = b'CSC110PK'
+
+
+def bundle_processed_data(packed_dir: str) -> None:
+    """
+    Concatenate the 7z shards in <packed_dir>/processed into a single seekable file,
+    <packed_dir>/processed.pak, so that the processed data can be copied as one file and read
+    without extracting it (see PackedData). The shards are copied as they are, without compressing
+    them again.
+
+    File format: PACK_MAGIC, the length of the index as an 8-byte little-endian integer, the json
+    index, then the shards. The index maps every shard name to its [offset, length] relative to the
+    end of the index, and every member path (relative to DATA_DIR) to [shard name, size].
+
+    Preconditions:
+        - pack_processed_data(packed_dir) has been called
+
+    :param packed_dir: Packed data directory
+    :return: None
+    """
+    shards = json.loads(read(f'{packed_dir}/processed/manifest.json'))['shards']
+    index = {'shards': {}, 'members': {}}
+    offset = 0
+    for name in sorted(shards):
+        length = os.path.getsize(f'{packed_dir}/processed/{name}')
+        index['shards'][name] = [offset, length]
+        offset += length
+        for member, (size, _) in shards[name]['files'].items():
+            index['members'][member] = [name, size]
+
+    file = f'{packed_dir}/processed.pak'
+    header = json_stringify(index).encode('utf-8')
+    with open(file + '.tmp', 'wb') as f:
+        f.write(PACK_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for name in sorted(shards):
+            with open(f'{packed_dir}/processed/{name}', 'rb') as shard:
+                shutil.copyfileobj(shard, f)
+    os.replace(file + '.tmp', file)
+    debug(f'Bundled {len(shards)} shards into {file} ({(offset + len(header)) / 1e6:.1f} MB)')
+
+
+class PackedData:
+    """
+    Read-only access to the processed data in a bundle written by bundle_processed_data. Members
+    are read by seeking to their shard and decompressing only that shard. Recently decompressed
+    shards are kept in memory up to cache_bytes, since members of a shard are often read together.
+
+    Attributes:
+        - file: Path of the bundle
+        - data_offset: Offset of the first shard in the bundle
+        - shards: shards[shard name] = [offset, length] of the shard relative to data_offset
+        - members: members[path relative to DATA_DIR] = [shard containing the member, size]
+        - cache_bytes: Max total size of the decompressed shards kept in memory
+
+    Representation Invariants:
+        - all(self.members[m][0] in self.shards for m in self.members)
+        - self.cache_bytes >= 0
+    """
+    file: str
+    data_offset: int
+    shards: dict[str, list[int]]
+    members: dict[str, list]
+    cache_bytes: int
+    _cache: OrderedDict[str, dict[str, bytes]]
+    _cached_bytes: int
+
+    def __init__(self, file: str, cache_bytes: int = 256 * 1024 * 1024) -> None:
+        self.file = file
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        with open(file, 'rb') as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError(f'{file} is not a processed data bundle')
+            length = int.from_bytes(f.read(8), 'little')
+            index = json.loads(f.read(length).decode('utf-8'))
+        self.data_offset = len(PACK_MAGIC) + 8 + length
+        self.shards = index['shards']
+        self.members = index['members']
+
+    def __contains__(self, member: str) -> bool:
+        return member in self.members
+
+    def _load_shard(self, name: str) -> dict[str, bytes]:
+        """
+        Decompress every member of a shard, or get it from the cache
+
+        :param name: Shard name
+        :return: Mapping of member path to content
+        """
+        if name in self._cache:
+            self._cache.move_to_end(name)
+            return self._cache[name]
+
+        offset, length = self.shards[name]
+        with open(self.file, 'rb') as f:
+            f.seek(self.data_offset + offset)
+            buf = f.read(length)
+        with SevenZipFile(io.BytesIO(buf), 'r') as z:
+            z: SevenZipFile = z
+            content = {m: b.read() for m, b in z.readall().items()}
+
+        # Keep the shard and evict the least recently used shards (but always keep this one)
+        self._cache[name] = content
+        self._cached_bytes += sum(len(b) for b in content.values())
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_bytes -= sum(len(b) for b in evicted.values())
+        return content
+
+    def read_bytes(self, member: str) -> bytes:
+        """
+        Read a member
+
+        :param member: Member path relative to DATA_DIR
+        :return: Content
+        """
+        if member not in self.members:
+            raise FileNotFoundError(f'{member} is not in {self.file}')
+        return self._load_shard(self.members[member][0])[member]
+
+    def read(self, member: str) -> str:
+        """
+        Read a text member
+
+        :param member: Member path relative to DATA_DIR
+        :return: Content
+        """
+        return self.read_bytes(member).decode('utf-8')
+
+    def extract(self, directory: str) -> None:
+        """
+        Extract every member of the bundle, which restores the processed data when the directory is
+        DATA_DIR. The shards are extracted one at a time, without keeping them in memory.
+
+        :param directory: Output directory
+        :return: None
+        """
+        with open(self.file, 'rb') as f:
+            for name, (offset, length) in self.shards.items():
+                debug(f'Extracting {name}...')
+                f.seek(self.data_offset + offset)
+                with SevenZipFile(io.BytesIO(f.read(length)), 'r') as z:
+                    z: SevenZipFile = z
+                    z.extractall(directory)
+
+
+def use_packed_data(file: Optional[str]) -> None:
+    """
+    Read processed data (load_users, load_user_sample, load_tweets, ...) directly from a bundle
+    written by bundle_processed_data instead of from DATA_DIR, so that the packed data doesn't need
+    to be extracted first.
+
+    :param file: Path of the bundle, or None to read from DATA_DIR again
+    :return: None
+    """
+    global _packed_data
+    _packed_data = PackedData(file) if file is not None else None
+    data_cache.clear()
+
+
+def packed_data_file() -> Optional[str]:
+    """
+    Get the packed data that processed data is read from (for passing on to worker processes)
+
+    :return: Path of the bundle, or None when reading from DATA_DIR
+    """
+    return _packed_data.file if _packed_data is not None else None
+
+
+def _data_member(file: str) -> str:
+    """
+    Get the member path of a data file in packed data
+
+    :param file: Data file path (under DATA_DIR)
+    :return: Member path relative to DATA_DIR (converted to lowercase like read() does)
+    """
+    return os.path.relpath(file.lower(), DATA_DIR).replace('\\', '/')
+
+
+def read_data(file: str) -> str:
+    """
+    Read a processed data file, from packed data if use_packed_data is enabled
+
+    :param file: Data file path (under DATA_DIR)
+    :return: File content
+    """
+    if _packed_data is not None:
+        return _packed_data.read(_data_member(file))
+    return read(file)
+
+
+def open_data(file: str) -> TextIO:
+    """
+    Open a processed data file for reading, from packed data if use_packed_data is enabled
+
+    :param file: Data file path (under DATA_DIR)
+    :return: Text stream
+    """
+    if _packed_data is not None:
+        return io.StringIO(read_data(file))
+    return open(file.lower(), 'r', encoding='utf-8')
+
+
+def pack_data(processes: Optional[int] = None) -> None:
     """
     This function packs processed data and raw data separately, and it also packs the data ready for
     submission on MarkUs
 
+    :param processes: Number of worker processes used to pack processed data
     :return: None
     """
     packed_dir = f'{DATA_DIR}/packed'
     Path(packed_dir).mkdir(parents=True, exist_ok=True)
-    packed_data = f'{packed_dir}/processed.7z'
     packed_res = f'{packed_dir}/resources.7z'
 
-    # Pack processed data (Since packing this takes a long time, we decided to not overwrite it for
-    # every run. This is also because the processed data hasn't changed since Nov 28 when the
-    # project is mostly finished, and there is no need to re-pack data every time, whereas the
-    # resources and sources might change after every update) So, delete the packed 7z file if you
-    # want to repack.
-    if not os.path.isfile(packed_data):
-        debug('Packing data...')
-        processed_dirs = ['/twitter/user/meta', '/twitter/user/processed',
-                          '/twitter/user-tweets/processed']
-        with SevenZipFile(packed_data, 'w') as z:
-            z: SevenZipFile = z
-            for p in processed_dirs:
-                debug(f'- Packing {p}')
-                z.writeall(DATA_DIR + p)
+    # Pack processed data. Only the data that changed since the last run is packed again.
+    debug('Packing data...')
+    pack_processed_data(packed_dir, processes)
 
     # Pack resources
     debug('Packing resources...')
@@ -386,10 +1398,16 @@ def pack_data() -> None:
 
 if __name__ == '__main__':
     python_ta.check_all(config={
-        'extra-imports': ['json', 'os', 'random', 'sys', 'zipfile', 'dataclasses', 'datetime',
-                          'pathlib', 'typing', 'requests', 'bs4', 'py7zr', 'constants', 'utils'
+        'extra-imports': ['bisect', 'hashlib', 'heapq', 'io', 'itertools', 'json', 'math',
+                          'multiprocessing', 'os', 'random', 'shutil', 'sys', 'tempfile', 'time',
+                          'zipfile', 'zlib', 'array', 'collections', 'dataclasses', 'datetime',
+                          'pathlib', 'typing', 'numpy', 'requests', 'bs4', 'py7zr', 'constants',
+                          'utils'
                           ],  # the names (strs) of imported modules
-        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        'allowed-io': ['_process_user_chunk', '_read_user_run', 'process_users',
+                       'bundle_processed_data', 'PackedData.__init__', 'PackedData._load_shard',
+                       'PackedData.extract', 'open_data'
+                       ],  # the names (strs) of functions that call print/open/input
         'max-line-length': 100,
         'disable': ['R1705', 'C0200']
     }, output='pyta_report.html')
@@ -2,81 +2,469 @@
 This module generates report HTML and serves it in an HTTP server.
 """
 
+import gzip
+import hashlib
+import inspect
 import json
+import mimetypes
 import os.path
-import shutil
+import re
+import threading
+import time
 import traceback
 import webbrowser
-from distutils.dir_util import copy_tree
+from datetime import datetime, timezone
+from importlib import metadata
 from pathlib import Path
+from typing import NamedTuple, Optional, Union, Any, Callable
 
-from flask import Flask, send_from_directory, Response
+import numpy as np
+from flask import Flask, send_from_directory, Response, Request, request
 
 import python_ta
 import python_ta.contracts
 
-from constants import REPORT_DIR, DEBUG, RES_DIR
-from utils import read, write
+# Brotli is optional, assets are only compressed with gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+# Waitress is optional, it's only used to serve the report in production mode
+try:
+    import waitress
+except ImportError:
+    waitress = None
 
-def generate_report() -> str:
+# Markdown-it and latex2mathml are optional, the page is rendered by the browser without them
+try:
+    from latex2mathml.converter import convert as latex_to_mathml
+    from markdown_it import MarkdownIt
+except ImportError:
+    latex_to_mathml, MarkdownIt = None, None
+
+from constants import REPORT_DIR, RES_DIR, DATA_DIR, PRERENDER, DEBUG
+from utils import read, debug, write, LRUCache, filter_days_avg_array, json_stringify
+
+
+def include_path(line: str) -> str:
     """
-    Compile the report document and generate a markdown report
+    Get the path of the file included by an @include statement, relative to REPORT_DIR
 
-    Preconditions:
-        - RES_DIR exists, and contains the necessary resources used in this project.
+    >>> include_path('@include-cut `/freq/500-rand-top-20.md` 0 8')
+    '/freq/500-rand-top-20.md'
 
-    :return: Markdown report
+    :param line: @include statement
+    :return: Path (starting with /)
     """
-    # Load markdown
-    md = read(os.path.join(RES_DIR, './report_document.md')).replace('\r\n', '\n').split('\n')
+    path = line[line.index('`') + 1:]
+    return path[:path.index('`')]
 
-    # Process line by line
-    for i in range(len(md)):
-        line = md[i]
-        if not line.startswith('@include'):
-            continue
 
-        # Process @include statements
+# Stamp of a file, (modification time in ns, size), or None if it doesn't exist
+FileStamp = Optional[tuple[int, int]]
+
+
+def file_stamp(path: str) -> FileStamp:
+    """
+    Get the stamp of a file, which changes when the file is modified
+
+    :param path: File path
+    :return: (Modification time in ns, size), or None if the file doesn't exist
+    """
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+class Section(NamedTuple):
+    """
+    A section of the report document, which starts at a heading (or at the start of the
+    document) and ends before the next heading
+
+    Attributes:
+        - title: Heading line of the section ('' for the part before the first heading)
+        - lines: Lines of the section in the document
+        - dependencies: Paths of the files included by the section, relative to REPORT_DIR
+    """
+    title: str
+    lines: tuple[str, ...]
+    dependencies: tuple[str, ...]
+
+
+class ReportCompiler:
+    """
+    Report document compiler, which resolves the @include statements of the report document.
+
+    The document is split into sections, and the compiler records the files each section
+    depends on. Included files are read and split once for all the statements including them,
+    and each statement is only resolved again when its file changes. Compiling a report again
+    only compiles the sections whose document lines or included files changed.
+
+    Attributes:
+        - document: Path of the report document
+        - sections: Sections of the document, with their dependencies (the dependency graph)
+
+    Representation Invariants:
+        - self.document != ''
+    """
+    document: str
+    sections: list[Section]
+
+    # _document_stamp = Stamp of the document when it was split into sections
+    _document_stamp: FileStamp
+    # _files[path] = (Stamp, lines) of an included file
+    _files: dict[str, tuple[FileStamp, list[str]]]
+    # _statements[line] = (Stamp of the included file, resolved text) of an @include statement
+    _statements: dict[str, tuple[FileStamp, str]]
+    # _compiled[section] = (Stamps of the dependencies, compiled text) of a section
+    _compiled: dict[Section, tuple[tuple[FileStamp, ...], str]]
+    _lock: threading.Lock
+
+    def __init__(self, document: str = os.path.join(RES_DIR, 'report_document.md')) -> None:
+        self.document = document
+        self.sections = []
+        self._document_stamp = None
+        self._files = {}
+        self._statements = {}
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def sources(self) -> list[str]:
+        """
+        Get the paths of all the files the report depends on
+
+        :return: Path of the document, then the included files
+        """
+        self._split_sections()
+        paths = [(REPORT_DIR + d).lower() for sec in self.sections for d in sec.dependencies]
+        return [self.document.lower()] + list(dict.fromkeys(paths))
+
+    def dependents(self, path: str) -> list[Section]:
+        """
+        Find the sections that depend on an included file
+
+        :param path: Path of the file, relative to REPORT_DIR (e.g. "/freq/stats.md")
+        :return: Sections including the file
+        """
+        self._split_sections()
+        return [sec for sec in self.sections if path in sec.dependencies]
+
+    def _split_sections(self) -> None:
+        """
+        Split the document into sections again if it was modified
+
+        :return: None
+        """
+        # Paths are converted to lowercase like in read and write
+        stamp = file_stamp(self.document.lower())
+        if stamp == self._document_stamp and self.sections:
+            return
+        md = read(self.document).replace('\r\n', '\n').split('\n')
+
+        starts = [0] + [i for i in range(1, len(md)) if md[i].startswith('#')] + [len(md)]
+        sections = []
+        for a, b in zip(starts, starts[1:]):
+            lines = tuple(md[a:b])
+            deps = []
+            for line in lines:
+                if line.startswith('@include') and '`' in line:
+                    deps.append(include_path(line))
+            sections.append(Section(lines[0] if lines[0].startswith('#') else '', lines,
+                                    tuple(dict.fromkeys(deps))))
+        self.sections = sections
+        self._document_stamp = stamp
+
+        # Forget sections that aren't in the document anymore
+        self._compiled = {k: v for k, v in self._compiled.items() if k in sections}
+
+    def _file_lines(self, path: str, stamp: FileStamp) -> list[str]:
+        """
+        Read the lines of an included file, or use the cached lines if it's not modified
+
+        :param path: Path of the file, relative to REPORT_DIR
+        :param stamp: Current stamp of the file
+        :return: Lines of the file
+        """
+        if path not in self._files or self._files[path][0] != stamp:
+            self._files[path] = (stamp, read(REPORT_DIR + path).split('\n'))
+        return self._files[path][1]
+
+    def _resolve(self, line: str) -> str:
+        """
+        Resolve an @include statement, or use the cached result if the file is not modified
+
+        :param line: @include statement
+        :return: Resolved text, or an error message
+        """
         # noinspection PyBroadException
         try:
-            path = line[line.index('`') + 1:]
-            path = path[:path.index('`')]
-            md[i] = read(REPORT_DIR + path)
+            path = include_path(line)
+            stamp = file_stamp((REPORT_DIR + path).lower())
+            if line in self._statements and self._statements[line][0] == stamp:
+                return self._statements[line][1]
+            lines = self._file_lines(path, stamp)
 
             # Cut lines
             # Format: @include-cut `path` <start, inclusive> [end, not inclusive]
             if line.startswith('@include-cut'):
                 args = [int(j) for j in line.split()[2:]]
                 if len(args) == 1:
-                    md[i] = '\n'.join(md[i].split('\n')[args[0]:])
+                    lines = lines[args[0]:]
                 if len(args) == 2:
-                    md[i] = '\n'.join(md[i].split('\n')[args[0]:args[1]])
+                    lines = lines[args[0]:args[1]]
 
             # Specific lines
             # Format: @include-lines `path` <...lines>
             # Example: @include-lines `path` 1 2 5
             if line.startswith('@include-lines'):
-                args = [int(j) for j in line.split()[2:]]
-                lines = md[i].split('\n')
+                args = {int(j) for j in line.split()[2:]}
                 lines = [lines[ln] for ln in range(len(lines)) if ln in args]
-                md[i] = '\n'.join(lines)
+
+            text = '\n'.join(lines)
+            self._statements[line] = (stamp, text)
+            return text
 
         # Handle errors. (It prompts "too broad an exception clause" but I actually need to catch
         # every possible exception.)
         except Exception:
-            md[i] = f"<pre class=\"error\">" \
-                    f"\nInvalid @include statement. \n{traceback.format_exc()}</pre>"
+            return f"<pre class=\"error\">" \
+                   f"\nInvalid @include statement. \n{traceback.format_exc()}</pre>"
+
+    def compile_sections(self) -> list[str]:
+        """
+        Compile the sections of the report document, resolving only the sections that changed
+
+        :return: Markdown of each section
+        """
+        with self._lock:
+            self._split_sections()
+            out = []
+            for sec in self.sections:
+                stamps = tuple(file_stamp((REPORT_DIR + d).lower()) for d in sec.dependencies)
+                if sec not in self._compiled or self._compiled[sec][0] != stamps:
+                    text = '\n'.join(self._resolve(ln) if ln.startswith('@include') else ln
+                                     for ln in sec.lines)
+                    self._compiled[sec] = (stamps, text)
+                out.append(self._compiled[sec][1])
+            return out
+
+    def compile(self) -> str:
+        """
+        Compile the report document, resolving only the sections that changed
+
+        :return: Markdown report
+        """
+        return '\n'.join(self.compile_sections())
+
 
-    return '\n'.join(md)
+# The report compiler used by generate_report
+report_compiler = ReportCompiler()
+
+
+def generate_report() -> str:
+    """
+    Compile the report document and generate a markdown report. Only the sections whose
+    included files changed since the last call are resolved again (see ReportCompiler).
+
+    Preconditions:
+        - RES_DIR exists, and contains the necessary resources used in this project.
+
+    :return: Markdown report
+    """
+    return report_compiler.compile()
+
+
+# Directory of the pre-rendered sections of the report (see prerender_section)
+PRERENDER_CACHE_DIR = f'{DATA_DIR}/cache/prerender'
+
+# In-memory cache of the pre-rendered sections, by hash of the content and renderer version
+prerender_cache = LRUCache(64 * 1024 * 1024)
+
+# TeX math in the report: display math in $$...$$ or \[...\], and inline math in \(...\)
+MATH_PATTERN = re.compile(r'\$\$(.+?)\$\$|\\\[(.+?)\\\]|\\\((.+?)\\\)', re.DOTALL)
+
+
+# Placeholder prefix of the heading ids in pre-rendered sections, which are made unique across the
+# whole report by unique_heading_ids
+HEADING_ID_PREFIX = 'HEADINGID:'
+
+
+def heading_slug(text: str, seen: dict[str, int]) -> str:
+    """
+    Create the id of a heading like marked.js does, so that links like [method](#method) work
+    the same in pre-rendered pages
 
+    >>> seen = {}
+    >>> heading_slug('1. Posting Frequency Over Time', seen), heading_slug('Method', seen)
+    ('1-posting-frequency-over-time', 'method')
+    >>> heading_slug('Method', seen)
+    'method-1'
 
-def generate_html() -> str:
+    :param text: Heading text
+    :param seen: seen[slug] = Number of headings with the slug so far (updated)
+    :return: Heading id
+    """
+    slug = re.sub(r'<[!/a-z].*?>', '', text.lower().strip(), flags=re.IGNORECASE)
+    slug = re.sub(r'[\u2000-\u206F\u2E00-\u2E7F\\\'!"#$%&()*+,./:;<=>?@\[\]^`{|}~]', '', slug)
+    slug = re.sub(r'\s', '-', slug)
+    return unique_slug(slug, seen)
+
+
+def unique_slug(slug: str, seen: dict[str, int]) -> str:
+    """
+    Make a heading slug unique by numbering repeated slugs like marked.js does
+
+    :param slug: Slug
+    :param seen: seen[slug] = Number of headings with the slug so far (updated)
+    :return: Heading id
+    """
+    if slug in seen:
+        seen[slug] += 1
+        return f'{slug}-{seen[slug] - 1}'
+    seen[slug] = 1
+    return slug
+
+
+def render_markdown(md: str) -> str:
+    """
+    Render markdown with TeX math to HTML. Math is converted to MathML, which browsers display
+    without any scripts.
+
+    Preconditions:
+        - MarkdownIt is not None and latex_to_mathml is not None
+
+    :param md: Markdown
+    :return: HTML
+    """
+    # Take the math out before rendering the markdown, so that it's not parsed as markdown
+    math = []
+
+    def take_math(m: re.Match) -> str:
+        display = m.group(3) is None
+        # noinspection PyBroadException
+        try:
+            mathml = latex_to_mathml(next(g for g in m.groups() if g is not None).strip(),
+                                     display='block' if display else 'inline')
+        except Exception:
+            mathml = f'<pre class="error">Invalid math.\n{traceback.format_exc()}</pre>'
+        math.append(mathml)
+        return f'MATHPLACEHOLDER{len(math) - 1}END'
+    md = MATH_PATTERN.sub(take_math, md)
+
+    # Heading ids depend on the headings before them in the whole report, so they're only
+    # placeholders here (see unique_heading_ids)
+    parser = MarkdownIt('gfm-like', {'html': True})
+    tokens = parser.parse(md)
+    for i, token in enumerate(tokens):
+        if token.type == 'heading_open':
+            token.attrSet('id', HEADING_ID_PREFIX + heading_slug(tokens[i + 1].content, {}))
+    html = parser.renderer.render(tokens, parser.options, {})
+
+    # Put the math back, display math takes up the whole paragraph
+    html = re.sub(r'<p>(MATHPLACEHOLDER\d+END)</p>', r'\1', html)
+    return re.sub(r'MATHPLACEHOLDER(\d+)END', lambda m: math[int(m.group(1))], html)
+
+
+def unique_heading_ids(html: str) -> str:
+    """
+    Replace the heading id placeholders of pre-rendered sections by ids that are unique across
+    the whole report
+
+    >>> unique_heading_ids('<h2 id="HEADINGID:a">A</h2><h3 id="HEADINGID:a">A</h3>')
+    '<h2 id="a">A</h2><h3 id="a-1">A</h3>'
+
+    :param html: HTML of the pre-rendered sections
+    :return: HTML
+    """
+    seen = {}
+    return re.sub(f' id="{HEADING_ID_PREFIX}([^"]*)"',
+                  lambda m: f' id="{unique_slug(m.group(1), seen)}"', html)
+
+
+def renderer_version() -> str:
+    """
+    Get a hash of the code and library versions that pre-render the report, so that cached
+    sections are rendered again whenever the renderer changes
+
+    :return: Hash
+    """
+    code = [render_markdown, heading_slug, unique_slug]
+    versions = []
+    for package in ['markdown-it-py', 'latex2mathml', 'linkify-it-py']:
+        try:
+            versions.append(metadata.version(package))
+        except metadata.PackageNotFoundError:
+            versions.append(None)
+    key = ''.join(inspect.getsource(c) for c in code) + MATH_PATTERN.pattern + str(versions)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def prerender_file(md: str, version: str) -> str:
+    """
+    Get the disk cache file of a pre-rendered section
+
+    :param md: Markdown of the section
+    :param version: Renderer version (see renderer_version)
+    :return: Path of the file (which might not exist)
+    """
+    return f'{PRERENDER_CACHE_DIR}/{hashlib.sha1((version + md).encode("utf-8")).hexdigest()}.html'
+
+
+def prerender_section(md: str, version: str) -> str:
+    """
+    Render a section of the report, or load it from the cache (in memory, then on disk) if a
+    section with the same content has been rendered by the same renderer
+
+    :param md: Markdown of the section
+    :param version: Renderer version (see renderer_version)
+    :return: HTML, with heading id placeholders (see unique_heading_ids)
+    """
+    file = prerender_file(md, version)
+
+    def load() -> str:
+        if os.path.isfile(file):
+            return read(file)
+        html = render_markdown(md)
+        write(file, html)
+        return html
+    return prerender_cache.get(file, None, load, len(md) * 2)
+
+
+def prerender_report() -> str:
+    """
+    Render the report to HTML. Only sections that changed are rendered again (see
+    prerender_section), and cached sections that aren't in the report anymore are removed from
+    the disk cache.
+
+    :return: HTML
+    """
+    version = renderer_version()
+    sections = report_compiler.compile_sections()
+    html = unique_heading_ids('\n'.join(prerender_section(md, version) for md in sections))
+
+    current = {Path(prerender_file(md, version)).name for md in sections}
+    for f in Path(PRERENDER_CACHE_DIR.lower()).glob('*.html'):
+        if f.name not in current:
+            f.unlink()
+    return html
+
+
+def generate_html(prerender: bool = PRERENDER) -> str:
     """
     Generate report then put it into the HTML template
 
+    :param prerender: Whether to render the report to HTML here (if markdown-it-py and
+    latex2mathml are installed), instead of rendering it in the browser with marked.js and
+    MathJax on every page load
     :return: HTML string
     """
+    if prerender and MarkdownIt is not None and latex_to_mathml is not None:
+        return read(os.path.join(RES_DIR, 'report_page_prerendered.html')) \
+            .replace('{{html}}', prerender_report())
+
     # Generate markdown report and JSON encode it (which works as JS code! amazing)
     md_json = json.dumps({'content': generate_report()})
     # Inject into HTML
@@ -85,76 +473,806 @@ def generate_html() -> str:
     return html
 
 
-def write_html() -> None:
+# Directory of the built static assets (see build_assets)
+ASSET_DIR = './assets'
+
+# Types of assets that get content-hashed file names (the ones referenced by the page)
+HASHED_TYPES = {'.js', '.css', '.png'}
+
+# Types of assets that are compressed (images and fonts are compressed already)
+COMPRESSED_TYPES = {'.html', '.js', '.css', '.md', '.json', '.txt', '.svg'}
+
+# Content encodings of the compressed variants, in the order of preference, and their suffixes
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# Cache-Control header of assets with content-hashed file names, which never change
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def asset_sources() -> dict[str, str]:
     """
-    Write HTML and copy files to ./dist
+    Find the files served by the report site: the html resources and the report directory
 
-    :return: None
+    :return: sources[url path] = file path
     """
-    if os.path.isdir('./dist'):
-        shutil.rmtree('./dist')
-    Path('./dist/html').mkdir(parents=True, exist_ok=True)
-    write('./dist/index.html', generate_html())
+    sources = {}
+    for directory, prefix in [(REPORT_DIR, ''), (os.path.join(RES_DIR, 'html'), '/html')]:
+        for root, _, files in os.walk(directory):
+            for f in files:
+                path = os.path.join(root, f)
+                sources[prefix + '/' + Path(os.path.relpath(path, directory)).as_posix()] = path
+    return sources
 
-    copy_tree(os.path.join(RES_DIR, 'html/'), './dist/html')
-    copy_tree(REPORT_DIR, './dist')
 
+def compress(data: bytes) -> dict[str, bytes]:
+    """
+    Compress data with every available content encoding. Variants that don't save at least 10%
+    aren't included.
 
-def serve_report() -> None:
+    :param data: Data
+    :return: variants[encoding] = Compressed data
     """
-    Serve report page in an http server.
+    variants = {'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data)
+    return {k: v for k, v in variants.items() if len(v) < len(data) * 0.9}
 
-    :return: None
+
+def _write_bytes(path: str, data: bytes) -> bool:
+    """
+    Write data to a file if its content is different
+
+    :param path: File path
+    :return: Whether the file is written
+    """
+    if os.path.isfile(path) and os.path.getsize(path) == len(data):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def build_assets(out: str = ASSET_DIR) -> dict[str, str]:
+    """
+    Build the static assets of the report site in the out directory. Every file is copied under
+    its own path, and files referenced by the page (see HASHED_TYPES) are also copied under a
+    content-hashed name ("/html/style.css" becomes "/html/style.<hash>.css"). Text files get
+    precompressed .gz (and .br, if brotli is installed) variants next to them.
+
+    Files are only written and compressed again when they change, and files that are not built
+    anymore are removed. The hashed names are saved in out/manifest.json as well.
+
+    :param out: Output directory
+    :return: hashed[url path] = Content-hashed url path
+    """
+    hashed = {}
+    built = {'/manifest.json'}
+    for url, path in asset_sources().items():
+        with open(path, 'rb') as f:
+            data = f.read()
+        urls = [url]
+        stem, ext = os.path.splitext(url)
+        if ext.lower() in HASHED_TYPES:
+            hashed[url] = f'{stem}.{hashlib.sha1(data).hexdigest()[:10]}{ext}'
+            urls.append(hashed[url])
+
+        # The data is compressed at most once, and only if it changed
+        variants = None
+        for u in urls:
+            built.add(u)
+            if _write_bytes(out + u, data) and ext.lower() in COMPRESSED_TYPES:
+                variants = compress(data) if variants is None else variants
+                for enc, suffix in ENCODINGS.items():
+                    if enc in variants:
+                        _write_bytes(out + u + suffix, variants[enc])
+                    elif os.path.isfile(out + u + suffix):
+                        os.remove(out + u + suffix)
+            built.update(u + x for x in ENCODINGS.values() if os.path.isfile(out + u + x))
+
+    # Remove assets that aren't built anymore (like old hashed names)
+    for root, _, files in os.walk(out):
+        for f in files:
+            path = Path(os.path.join(root, f))
+            if '/' + path.relative_to(out).as_posix() not in built:
+                path.unlink()
+    _write_bytes(f'{out}/manifest.json', json.dumps(hashed, indent=1).encode('utf-8'))
+    return hashed
+
+
+def hash_asset_urls(html: str, hashed: dict[str, str]) -> str:
+    """
+    Replace the asset urls in the page (relative like "html/style.css" or absolute like
+    "/html/style.css", in HTML attributes or in the JSON-encoded markdown) by their hashed urls
+
+    >>> hash_asset_urls('<img src="html/a.png"> url(/b.png) "/b.png.txt"',
+    ...                 {'/html/a.png': '/html/a.1.png', '/b.png': '/b.2.png'})
+    '<img src="/html/a.1.png"> url(/b.2.png) "/b.png.txt"'
+
+    :param html: HTML of the page
+    :param hashed: hashed[url path] = Content-hashed url path (see build_assets)
+    :return: HTML with the hashed urls
+    """
+    if not hashed:
+        return html
+    urls = '|'.join(re.escape(u[1:]) for u in sorted(hashed, key=len, reverse=True))
+    pattern = re.compile(f'(?<=["\'(])/?({urls})(?=\\\\?["\')])')
+    return pattern.sub(lambda m: hashed['/' + m.group(1)], html)
+
+
+def choose_encoding(req: Request, variants: Union[set[str], dict[str, Any]]) -> str:
+    """
+    Choose the content encoding of a response by the Accept-Encoding header of the request
+
+    :param req: Request
+    :param variants: Available encodings
+    :return: Content encoding, or 'identity' if the response should not be compressed
+    """
+    for enc in ENCODINGS:
+        if enc in variants and req.accept_encodings.quality(enc) > 0:
+            return enc
+    return 'identity'
+
+
+def send_asset(req: Request, url: str, immutable: set[str]) -> Response:
+    """
+    Send a built asset, or its compressed variant if the client accepts it
+
+    :param req: Request
+    :param url: Url path of the asset
+    :param immutable: Url paths of the assets that have content-hashed names
+    :return: File response, or 404
+    """
+    directory = Path(ASSET_DIR).absolute()
+    path = url[1:]
+    variants = {e for e, x in ENCODINGS.items() if (directory / (path + x)).is_file()}
+    enc = choose_encoding(req, variants)
+    resp = send_from_directory(directory, path + ENCODINGS.get(enc, ''),
+                               mimetype=mimetypes.guess_type(path)[0])
+    if enc != 'identity':
+        resp.headers['Content-Encoding'] = enc
+    if variants:
+        resp.vary.add('Accept-Encoding')
+    if url in immutable:
+        resp.headers['Cache-Control'] = IMMUTABLE
+    else:
+        resp.cache_control.no_cache = True
+    return resp
+
+
+class PageSnapshot(NamedTuple):
+    """
+    One generated version of the report page. A new snapshot replaces the old one in a single
+    assignment, so a request never sees the fields of two different versions.
+
+    Attributes:
+        - html: Report page HTML
+        - variants: variants[encoding] = Compressed HTML (see compress)
+        - etag: Entity tag of the page (hash of the HTML)
+        - last_modified: Latest modification time of the source files (unix seconds)
+        - hashed: hashed[url path] = Content-hashed url path of an asset
+        - immutable: Content-hashed url paths of the assets
+        - asset_files: asset_files[url path] = Source file of an asset (under its own and its
+        hashed url)
+        - stamps: stamps[path] = Stamp of a source file when the page was generated (see
+        file_stamp)
+
+    Representation Invariants:
+        - self.etag != ''
+    """
+    html: str
+    variants: dict[str, bytes]
+    etag: str
+    last_modified: float
+    hashed: dict[str, str]
+    immutable: set[str]
+    asset_files: dict[str, str]
+    stamps: dict[str, FileStamp]
+
+
+class CachedPage:
+    """
+    The report page HTML, cached in memory and only generated again when one of its source files
+    (the report document, the page template, or an asset like a file included by the document)
+    is modified. The assets are built again with the page (see build_assets), and the page refers
+    to them by their content-hashed urls.
+
+    Attributes:
+        - snapshot: Current version of the page, or None if it hasn't been generated yet
+        - check_interval: Minimum number of seconds between checking whether the page is stale
+
+    Representation Invariants:
+        - self.check_interval >= 0
+    """
+    snapshot: Optional[PageSnapshot]
+    check_interval: float
+    _checked: float
+    _lock: threading.Lock
+
+    def __init__(self, check_interval: float = 0) -> None:
+        self.snapshot = None
+        self.check_interval = check_interval
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sources() -> list[str]:
+        """
+        Find the source files of the report page, using the dependency graph of the report
+
+        :return: Paths of the page template, the report document, the included files and the
+        assets
+        """
+        return list(dict.fromkeys([os.path.join(RES_DIR, 'report_page.html'),
+                                   os.path.join(RES_DIR, 'report_page_prerendered.html')]
+                                  + report_compiler.sources()
+                                  + list(asset_sources().values())))
+
+    def stale(self) -> bool:
+        """
+        Check whether any source file has been modified since the page was generated
+
+        :return: True if the page has to be generated again
+        """
+        snapshot = self.snapshot
+        return snapshot is None or \
+            any(file_stamp(p) != t for p, t in snapshot.stamps.items())
+
+    def update(self) -> PageSnapshot:
+        """
+        Generate the page again if it's stale. If the page was checked less than check_interval
+        seconds ago, it's not checked again.
+
+        :return: Current version of the page
+        """
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() - self._checked < self.check_interval:
+            return snapshot
+        with self._lock:
+            self._checked = time.monotonic()
+            if self.stale():
+                # The stamps are read before generating, so that a file modified while generating
+                # makes the page stale again instead of being missed
+                stamps = {p: file_stamp(p) for p in self.sources()}
+                hashed = build_assets()
+                files = asset_sources()
+                html = hash_asset_urls(generate_html(), hashed)
+                self.snapshot = PageSnapshot(
+                    html, compress(html.encode('utf-8')),
+                    hashlib.sha1(html.encode('utf-8')).hexdigest(),
+                    max(t[0] / 1e9 for t in stamps.values() if t), hashed, set(hashed.values()),
+                    {**files, **{h: files[u] for u, h in hashed.items()}}, stamps)
+                debug('Generated the report page.')
+            return self.snapshot
+
+    def update_asset(self, url: str) -> PageSnapshot:
+        """
+        Make sure that a built asset is up to date before it's sent. Only the asset's own source
+        file is checked, and the page and the assets are built again if it was modified. Unknown
+        urls (which might be new files) check the whole page like update.
+
+        :param url: Url path of the asset
+        :return: Current version of the page
+        """
+        snapshot = self.snapshot
+        path = None if snapshot is None else snapshot.asset_files.get(url)
+        if path is None or file_stamp(path) != snapshot.stamps.get(path):
+            return self.update()
+        return snapshot
+
+    def response(self, req: Request) -> Response:
+        """
+        Create a response of the page for a request. The response has the ETag and Last-Modified
+        headers, and is 304 Not Modified if the client has the same page already. The page is
+        compressed if the client accepts it.
+
+        :param req: Request
+        :return: Response
+        """
+        page = self.update()
+        enc = choose_encoding(req, page.variants)
+        if enc == 'identity':
+            resp = Response(page.html, mimetype='text/html')
+        else:
+            resp = Response(page.variants[enc], mimetype='text/html')
+            resp.headers['Content-Encoding'] = enc
+        resp.vary.add('Accept-Encoding')
+        resp.set_etag(page.etag if enc == 'identity' else f'{page.etag}-{enc}')
+        resp.last_modified = datetime.fromtimestamp(int(page.last_modified), timezone.utc)
+        # Browsers should check whether the page changed every time (which is a 304 if it didn't)
+        resp.cache_control.no_cache = True
+        return resp.make_conditional(req)
+
+
+class SyncResult(NamedTuple):
+    """
+    Files changed by a directory sync (see sync_dir), as paths relative to the destination
+
+    Attributes:
+        - added: New files
+        - changed: Files with changed contents
+        - removed: Files that were removed
+    """
+    added: list[str]
+    changed: list[str]
+    removed: list[str]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self) -> str:
+        return f'{len(self.added)} added, {len(self.changed)} changed, ' \
+               f'{len(self.removed)} removed'
+
+
+# Sync manifest of ./dist (see sync_dir). It's kept outside ./dist so that it isn't deployed.
+DIST_SYNC_MANIFEST = f'{DATA_DIR}/cache/dist-sync.json'
+
+
+def sync_dir(src: str, dst: str, manifest_file: str, keep: set[str],
+             include: Optional[Callable[[str], bool]] = None) -> SyncResult:
+    """
+    Make the dst directory a copy of the src directory, only copying new files and files whose
+    contents changed, and removing files that aren't in src anymore.
+
+    The content hashes are saved in the sync manifest with the stamps of both copies (see
+    file_stamp), so a file is only read again when one of its copies is modified.
+
+    :param src: Source directory
+    :param dst: Destination directory
+    :param manifest_file: Path of the sync manifest
+    :param keep: Names in dst that are not synced and never removed (like .git)
+    :param include: Function that decides whether a file in src (a path relative to src) is
+    synced (Default: every file)
+    :return: Files changed
+    """
+    try:
+        manifest = json.loads(read(manifest_file))
+    except (OSError, ValueError):
+        manifest = {}
+    result = SyncResult([], [], [])
+
+    def files(directory: str) -> set[str]:
+        out = set()
+        for root, dirs, names in os.walk(directory):
+            rel = Path(os.path.relpath(root, directory)).as_posix()
+            if rel == '.':
+                dirs[:] = [d for d in dirs if d not in keep]
+                names = [n for n in names if n not in keep]
+            out.update(n if rel == '.' else f'{rel}/{n}' for n in names)
+        return out
+
+    new_manifest = {}
+    old_files = files(dst) if os.path.isdir(dst) else set()
+    for f in sorted(f for f in files(src) if include is None or include(f)):
+        src_stamp, dst_stamp = list(file_stamp(os.path.join(src, f))), \
+            list(file_stamp(os.path.join(dst, f)) or [])
+        record = manifest.get(f)
+        if record and record['src'] == src_stamp and record['dst'] == dst_stamp:
+            new_manifest[f] = record
+            continue
+
+        with open(os.path.join(src, f), 'rb') as fp:
+            data = fp.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if f in old_files:
+            if not (record and record['dst'] == dst_stamp):
+                with open(os.path.join(dst, f), 'rb') as fp:
+                    record = {'hash': hashlib.sha1(fp.read()).hexdigest()}
+            if record['hash'] != digest:
+                _write_bytes(os.path.join(dst, f), data)
+                result.changed.append(f)
+        else:
+            _write_bytes(os.path.join(dst, f), data)
+            result.added.append(f)
+        new_manifest[f] = {'hash': digest, 'src': src_stamp,
+                           'dst': list(file_stamp(os.path.join(dst, f)))}
+
+    # Remove deleted files, and directories that became empty
+    for f in sorted(old_files - set(new_manifest)):
+        os.remove(os.path.join(dst, f))
+        result.removed.append(f)
+    for root, dirs, names in os.walk(dst, topdown=False):
+        if root != dst and not dirs and not names and os.path.basename(root) not in keep:
+            os.rmdir(root)
+
+    _write_bytes(manifest_file, json.dumps(new_manifest).encode('utf-8'))
+    return result
+
+
+# Files in ./dist that are not synced from the assets: the page, and the git repo, domain and
+# packed data of the deployment (see deploy.sh)
+DIST_KEEP = {'.git', 'CNAME', 'processed-data.pak', 'index.html'}
+
+
+def write_html() -> SyncResult:
+    """
+    Write HTML and sync the built assets to ./dist. Only new or changed files are copied, and files
+    that aren't built anymore are removed.
+
+    Only the files that a static host needs are synced: files referenced by the page are only
+    synced under their hashed names, and the compressed variants and the asset manifest, which
+    are only used by serve_report, are left out.
+
+    :return: Files changed in ./dist
+    """
+    hashed = build_assets()
+    skipped = {u[1:] for u in hashed} | {'manifest.json'}
+    result = sync_dir(ASSET_DIR, './dist', DIST_SYNC_MANIFEST, DIST_KEEP,
+                      lambda f: f not in skipped and not f.endswith(tuple(ENCODINGS.values())))
+    if _write_bytes('./dist/index.html',
+                    hash_asset_urls(generate_html(), hashed).encode('utf-8')):
+        result.changed.append('index.html')
+
+    debug(f'Synced ./dist: {result}')
+    for name, files in zip(['Added', 'Changed', 'Removed'], result):
+        for f in files:
+            debug(f'- {name} {f}')
+    return result
+
+
+class SampleArrays(NamedTuple):
+    """
+    The computed data of a sample, as arrays for the data API
+
+    Attributes:
+        - name: Sample name
+        - users: Number of users in the sample
+        - dates: dates[i] = The i-th day of the change analysis
+        - date_freqs: date_freqs[i] = COVID-posting frequency of the sample on dates[i]
+        - date_pops: date_pops[i] = Popularity ratio of the sample's COVID posts on dates[i]
+        - freq_users, freq_values: Users and their COVID-posting frequencies (sorted, descending)
+        - pop_users, pop_values: Users and their popularity ratios (sorted, descending)
+
+    Representation Invariants:
+        - len(self.dates) == len(self.date_freqs) == len(self.date_pops)
+        - len(self.freq_users) == len(self.freq_values)
+        - len(self.pop_users) == len(self.pop_values)
+    """
+    name: str
+    users: int
+    dates: np.ndarray
+    date_freqs: np.ndarray
+    date_pops: np.ndarray
+    freq_users: list[str]
+    freq_values: np.ndarray
+    pop_users: list[str]
+    pop_values: np.ndarray
+
+
+class ApiError(Exception):
+    """
+    An error of a data API request, which is sent to the client as a JSON error message
+
+    Attributes:
+        - status: HTTP status code
+    """
+    status: int
+
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+# Max number of users in a top-N list of the data API
+API_MAX_TOP = 1000
+
+# Number of seconds that clients should wait before trying again while the data API is loading
+API_RETRY_AFTER = 5
+
+
+class DataApi:
+    """
+    JSON data API over the computed samples. The samples are loaded into arrays in a background
+    thread, which is started by the first request (see start), and requests are answered with 503
+    Service Unavailable until they're loaded. The responses are cached by their endpoint and
+    query parameters.
+
+    Endpoints (every parameter except sample is optional):
+        - /api/samples: Names, sizes and date ranges of the samples
+        - /api/series?sample=&kind=freq|pop&start=&end=&smooth=: Daily COVID-posting frequency or
+        popularity ratio of a sample from start to end (exclusive, "YYYY-MM-DD"), averaged over
+        smooth days around each day
+        - /api/users?sample=&kind=freq|pop: Frequency or popularity ratio of each user
+        - /api/top?sample=&kind=freq|pop&n=: Top-n users by frequency or popularity ratio
+
+    Attributes:
+        - cache: Cache of the JSON responses (each response has size 1, so its max_bytes is the
+        max number of cached responses)
+    """
+    cache: LRUCache
+    _loader: Callable[[], list]
+    _samples: Optional[dict[str, SampleArrays]]
+    _failed: bool
+    _thread: Optional[threading.Thread]
+    _lock: threading.Lock
+
+    def __init__(self, loader: Optional[Callable[[], list]] = None,
+                 cache_size: int = 4096) -> None:
+        """
+        :param loader: Function that loads the samples (Default: load_cached_samples in
+        visualization, which only reads the sample cache)
+        :param cache_size: Max number of cached responses
+        """
+        self.cache = LRUCache(cache_size)
+        self._loader = loader
+        self._samples = None
+        self._failed = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        Load the samples into arrays. This is run by the background thread of start, but it can
+        also be called directly to load the samples before serving.
+
+        :return: None
+        """
+        loader = self._loader
+        if loader is None:
+            # Imported here so that serving the report doesn't need the data until the API is used
+            from visualization import load_cached_samples
+            loader = load_cached_samples
+        # noinspection PyBroadException
+        try:
+            samples = {}
+            for s in loader():
+                samples[s.name] = SampleArrays(
+                    s.name, len(s.users), np.array(s.dates, 'datetime64[D]'),
+                    np.array(s.date_freqs, float), np.array(s.date_pops, float),
+                    [u.name for u in s.user_freqs], np.array([u.data for u in s.user_freqs]),
+                    [u.name for u in s.user_pops], np.array([u.data for u in s.user_pops]))
+        except Exception:
+            self._failed = True
+            debug(f'Failed to load the samples for the data API.\n{traceback.format_exc()}')
+            return
+        self._samples = samples
+        debug(f'Loaded {len(samples)} samples for the data API.')
+
+    def start(self) -> 'DataApi':
+        """
+        Start loading the samples in a background thread, unless it's started already
+
+        :return: self
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.load, name='data-api', daemon=True)
+                self._thread.start()
+        return self
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the background thread finishes loading the samples
+
+        :param timeout: Max number of seconds to wait (Default: no limit)
+        :return: Whether the samples are loaded
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return self._samples is not None
+
+    def samples(self) -> dict[str, SampleArrays]:
+        """
+        Get the loaded samples. An ApiError is raised if they aren't loaded yet (or failed to
+        load), which the client receives as a 503 (or 500) error.
+
+        :return: samples[name] = Sample arrays
+        """
+        samples = self._samples
+        if samples is None:
+            if self._failed:
+                raise ApiError('The data could not be loaded', 500)
+            self.start()
+            raise ApiError('The data is still loading, please try again later', 503)
+        return samples
+
+    def _sample(self, args: dict[str, str]) -> SampleArrays:
+        samples = self.samples()
+        if args.get('sample') not in samples:
+            raise ApiError(f'Unknown sample, the samples are {list(samples)}', 404)
+        return samples[args['sample']]
+
+    @staticmethod
+    def _kind(args: dict[str, str]) -> str:
+        kind = args.get('kind', 'freq')
+        if kind not in ('freq', 'pop'):
+            raise ApiError('kind must be freq or pop')
+        return kind
+
+    @staticmethod
+    def _int(args: dict[str, str], name: str, default: int, low: int, high: int) -> int:
+        try:
+            value = int(args.get(name, default))
+        except ValueError:
+            raise ApiError(f'{name} must be an integer') from None
+        if not low <= value <= high:
+            raise ApiError(f'{name} must be between {low} and {high}')
+        return value
+
+    def _series(self, args: dict[str, str]) -> dict[str, Any]:
+        s = self._sample(args)
+        values = s.date_freqs if self._kind(args) == 'freq' else s.date_pops
+        smooth = self._int(args, 'smooth', 1, 1, len(values))
+        try:
+            start = np.datetime64(args.get('start', str(s.dates[0])), 'D')
+            end = np.datetime64(args.get('end', str(s.dates[-1] + 1)), 'D')
+        except ValueError:
+            raise ApiError('start and end must be dates in YYYY-MM-DD') from None
+
+        # Smooth the whole series first, so that the days at the edges are averaged with the
+        # days outside the range too
+        values = filter_days_avg_array(values, smooth)
+        a, b = np.searchsorted(s.dates, [start, end])
+        return {'sample': s.name, 'dates': np.datetime_as_string(s.dates[a:b]).tolist(),
+                'values': values[a:b].tolist()}
+
+    def _users(self, args: dict[str, str], n: Optional[int] = None) -> dict[str, Any]:
+        s = self._sample(args)
+        users, values = (s.freq_users, s.freq_values) if self._kind(args) == 'freq' \
+            else (s.pop_users, s.pop_values)
+        return {'sample': s.name, 'users': users[:n], 'values': values[:n].tolist()}
+
+    def _list_samples(self) -> list[dict[str, Any]]:
+        return [{'name': s.name, 'users': s.users, 'start': str(s.dates[0]),
+                 'end': str(s.dates[-1] + 1)} for s in self.samples().values()]
+
+    def handle(self, endpoint: str, args: dict[str, str]) -> Response:
+        """
+        Handle a data API request
+
+        :param endpoint: Endpoint name ("samples", "series", "users" or "top")
+        :param args: Query parameters
+        :return: JSON response, or a JSON error message
+        """
+        handlers = {'samples': lambda: self._list_samples(),
+                    'series': lambda: self._series(args),
+                    'users': lambda: self._users(args),
+                    'top': lambda: self._users(args, self._int(args, 'n', 20, 1, API_MAX_TOP))}
+        if endpoint not in handlers:
+            return Response(json_stringify({'error': f'Unknown endpoint {endpoint}'}), 404,
+                            mimetype='application/json')
+
+        key = (endpoint, tuple(sorted(args.items())))
+        try:
+            body = self.cache.get(key, None, lambda: json_stringify(handlers[endpoint]()), 1)
+        except ApiError as e:
+            resp = Response(json_stringify({'error': str(e)}), e.status,
+                            mimetype='application/json')
+            if e.status == 503:
+                resp.headers['Retry-After'] = str(API_RETRY_AFTER)
+            return resp
+        return Response(body, mimetype='application/json')
+
+
+# Number of seconds between checking whether the report page changed in production mode
+PRODUCTION_CHECK_INTERVAL = 5
+
+
+def create_app(page: CachedPage, api: Optional[DataApi] = None) -> Flask:
+    """
+    Create the flask app of the report website. Creating the app doesn't generate the page or
+    load any data: the data API only starts loading its samples on its first request.
+
+    >>> loads, ready = [], threading.Event()
+    >>> api = DataApi(lambda: ready.wait() and loads.append('load') or [])
+    >>> client = create_app(CachedPage(), api).test_client()
+    >>> loads
+    []
+    >>> client.get('/api/samples').status_code
+    503
+    >>> import contextlib, io
+    >>> with contextlib.redirect_stdout(io.StringIO()):  # Hide the debug log of the loader thread
+    ...     ready.set()
+    ...     loaded = api.wait()
+    >>> loaded, loads, client.get('/api/samples').json
+    (True, ['load'], [])
+
+    :param page: Cached report page
+    :param api: Data API (Default: a data API over the cached samples, see load_cached_samples)
+    :return: Flask app
     """
-    # Create flask app
     app = Flask(__name__)
-    html = generate_html()
+    api = DataApi() if api is None else api
+
+    @app.route('/api/<endpoint>')
+    def data_api(endpoint: str) -> Response:
+        """
+        Data API endpoint (see DataApi)
+
+        :param endpoint: Endpoint name
+        :return: JSON response
+        """
+        return api.handle(endpoint, request.args.to_dict())
 
     @app.route('/')
-    def root() -> str:
+    def root() -> Response:
         """
-        Root webpage. If debug mode is enabled, generate new HTML every time the web page is
-        accessed. Else, serve the generated HTML.
+        Root webpage. The HTML is cached, and only generated again when the report document or the
+        files it includes are modified.
 
-        :return: HTML report
+        :return: HTML report, or 304 Not Modified
         """
-        if DEBUG:
-            return generate_html()
-        else:
-            return html
+        return page.response(request)
 
     @app.route('/<path:path>')
     def res(path: str) -> Response:
         """
-        Resources endpoint. This function maps report queries to the report directory
+        Resources endpoint. This function maps report queries to the built assets of the report
+        directory
 
         :param path: Path of the resource
         :return: File resource or 404
         """
-        return send_from_directory(Path(REPORT_DIR).absolute(), path)
+        return send_asset(request, '/' + path, page.update_asset('/' + path).immutable)
 
     @app.route('/html/<path:path>')
     def js_res(path: str) -> Response:
         """
-        JS Resource endpoint. This maps JS and CSS queries to the resources directory
+        JS Resource endpoint. This maps JS and CSS queries to the built assets of the resources
+        directory
 
         :param path: Path of the resource
         :return: File resource or 404
         """
-        return send_from_directory(os.path.join(RES_DIR, 'html'), path)
+        return send_asset(request, '/html/' + path,
+                          page.update_asset('/html/' + path).immutable)
+
+    return app
+
+
+def serve_report(production: bool = not DEBUG, port: int = 8080, threads: int = 8,
+                 host: str = '127.0.0.1') -> None:
+    """
+    Serve report page in an http server. The server only accepts connections from this computer,
+    unless another host (like '0.0.0.0' for every network interface) is given.
+
+    In production mode, the report is served by waitress, a multi-threaded WSGI server. It sends
+    files with the server's file wrapper. The page is kept in memory
+    and only checked for changes every PRODUCTION_CHECK_INTERVAL seconds. Otherwise, flask's
+    development server is used, the page is checked on every request, and the page is opened in
+    a browser.
+
+    The data API (see DataApi) is served under /api in both modes.
+
+    :param production: Whether to serve in production mode
+    :param port: Port
+    :param threads: Number of worker threads (production mode only)
+    :param host: Address to listen on
+    :return: None
+    """
+    if production and waitress is None:
+        debug('Waitress is not installed, serving with the development server instead.')
+        production = False
+
+    page = CachedPage(PRODUCTION_CHECK_INTERVAL if production else 0)
+    page.update()
+    app = create_app(page)
 
     # Run app
-    webbrowser.open("http://localhost:8080")
-    app.run(port=8080)
+    if production:
+        debug(f'Serving on http://{host}:{port} with {threads} threads')
+        waitress.serve(app, host=host, port=port, threads=threads, ident='report')
+    else:
+        webbrowser.open(f'http://localhost:{port}')
+        app.run(host=host, port=port)
 
 
 if __name__ == '__main__':
     python_ta.contracts.check_all_contracts()
     python_ta.check_all(config={
-        'extra-imports': ['json', 'os.path', 'shutil', 'traceback', 'webbrowser',
-                          'distutils.dir_util', 'pathlib', 'flask', 'constants', 'utils'
+        'extra-imports': ['gzip', 'hashlib', 'inspect', 'json', 'mimetypes', 'os.path', 're',
+                          'threading', 'time', 'traceback', 'webbrowser', 'datetime', 'importlib',
+                          'pathlib', 'typing', 'flask', 'brotli', 'waitress',
+                          'latex2mathml.converter', 'markdown_it', 'numpy', 'visualization',
+                          'constants', 'utils'
                           ],  # the names (strs) of imported modules
-        'allowed-io': [],  # the names (strs) of functions that call print/open/input
+        # the names (strs) of functions that call print/open/input
+        'allowed-io': ['_write_bytes', 'build_assets', 'sync_dir'],
         'max-line-length': 100,
         'disable': ['R1705', 'C0200', 'R1702', 'W0703']
     })
@@ -0,0 +1,35 @@
+// Make images clickable
+// Improved from: https://stackoverflow.com/a/50430187/7346633
+body = $('body')
+$('img').addClass('clickable').click(function() {
+    const src = $(this).attr('src');
+    let modal;
+
+    function removeModal() {
+        modal.remove();
+        body.off('keyup.modal-close');
+    }
+
+    modal = $('<div id="modal">').css({
+        background: 'RGBA(0,0,0,.5) url(' + src + ') no-repeat center',
+        backgroundSize: $(this).hasClass('large') ? 'contain' : 'auto',
+        width: '100vw',
+        height: '100vh',
+        position: 'fixed',
+        zIndex: '100',
+        top: '0',
+        left: '0',
+        cursor: 'zoom-out'
+    }).click(function() {
+        removeModal();
+    }).appendTo('body');
+
+    // Handling keyboard shortcuts
+    body.on('keyup.modal-close', (e) => {
+        if (e.key === 'Escape') removeModal();
+        if (e.key === 'e') modal.removeClass('zoom')
+    });
+    body.on('keydown.modal-close', (e) => {
+        if (e.key === 'e') modal.addClass('zoom')
+    })
+});
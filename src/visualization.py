@@ -4,25 +4,35 @@ report directory.
 The graphs are created after processing the data, for example with filtering and removing outliers.
 """
 
+import hashlib
+import inspect
+import json
+import multiprocessing
 import os.path
+import shutil
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Union
+from typing import Optional, Union, NamedTuple, Callable, Any
 
+import matplotlib
 import matplotlib.dates as mdates
 import matplotlib.ticker
+import numpy as np
 import scipy.signal
 from matplotlib import pyplot as plt, font_manager
 
 import python_ta
 import python_ta.contracts
 
-from collect_others import get_covid_cases_us
-from constants import RES_DIR, REPORT_DIR
-from processing import load_tweets, load_user_sample
-from utils import debug, daterange, map_to_dates, filter_days_avg, Reporter, remove_outliers, \
-    tabulate_stats, get_statistics
+from collect_others import get_covid_cases_us, CasesData
+from constants import RES_DIR, REPORT_DIR, DATA_DIR
+from processing import load_tweet_arrays, load_user_sample, PostingArrays, UserSample, \
+    use_packed_data, packed_data_file, tweets_signature
+from utils import debug, read, write, daterange, map_to_dates, map_to_dates_array, \
+    filter_days_avg_array, Reporter, remove_outliers, tabulate_stats, get_statistics, \
+    json_stringify, bootstrap_statistics, bootstrap_curve, tabulate_intervals, StatsIntervals, \
+    lagged_correlation, divide_zeros_array
 
 
 @dataclass()
@@ -44,10 +54,471 @@ class UserFloat:
     data: float
 
 
+# Postings before this time are ignored in our analysis (the start of COVID)
+POSTINGS_SINCE = np.datetime64('2020-01-01T01:01:01')
+
+
+# Default date range of the change analysis (the end date is exclusive)
+ANALYSIS_START = '2020-01-01'
+ANALYSIS_END = '2021-11-25'
+
+# Default number of previous days included in the moving average of the popularity ratio on a date
+CHANGE_WINDOW = 7
+
+# Number of bootstrap resamples and confidence level of the confidence intervals in the report
+BOOTSTRAP_RESAMPLES = 10000
+CONFIDENCE = 0.95
+
+# Lags (in days) between the COVID-posting curves and the US cases/deaths curves in the lag analysis
+MAX_LAG = 60
+# Users need this many COVID posts to be included in the per-user lag analysis
+LAG_MIN_COVID_POSTS = 10
+
+
+class UserDays(NamedTuple):
+    """
+    Daily totals of one user's postings posted after POSTINGS_SINCE. Only the days that the user
+    posted on are stored. Everything except repost only counts original posts (not reposts).
+
+    Attributes:
+        - days: Sorted days that the user posted on (datetime64[D])
+        - count: count[i] = Number of posts on days[i]
+        - covid: covid[i] = Number of COVID-related posts on days[i]
+        - pop: pop[i] = Total popularity of the posts on days[i]
+        - covid_pop: covid_pop[i] = Total popularity of the COVID-related posts on days[i]
+        - repost: repost[i] = Number of reposts on days[i]
+
+    Representation Invariants:
+        - len(self.days) == len(self.count) == len(self.covid) == len(self.pop)
+        - len(self.days) == len(self.covid_pop) == len(self.repost)
+        - all(self.count + self.repost > 0) and all(self.covid <= self.count)
+    """
+    days: np.ndarray
+    count: np.ndarray
+    covid: np.ndarray
+    pop: np.ndarray
+    covid_pop: np.ndarray
+    repost: np.ndarray
+
+
+def aggregate_user_days(postings: PostingArrays) -> UserDays:
+    """
+    Group a user's postings by day with vectorized grouped sums, replacing a Python loop over every
+    tweet. The sums are computed in float64 and are exact since they are integers below 2^53.
+
+    :param postings: User's postings
+    :return: Daily totals
+    """
+    keep = postings.time > POSTINGS_SINCE
+    days, inverse = np.unique(postings.time[keep].astype('datetime64[D]'), return_inverse=True)
+    original = ~postings.repost[keep]
+    covid = postings.covid_related[keep] & original
+    pop = postings.popularity[keep] * original
+    n = len(days)
+    return UserDays(days, np.bincount(inverse, original, n).astype(np.int64),
+                    np.bincount(inverse, covid, n).astype(np.int64),
+                    np.bincount(inverse, pop, n).astype(np.int64),
+                    np.bincount(inverse, pop * covid, n).astype(np.int64),
+                    np.bincount(inverse, ~original, n).astype(np.int64))
+
+
+class SampleAggregate(NamedTuple):
+    """
+    Per-user results and daily totals of a list of users, calculated by UserDayCube.aggregate.
+    Samples are calculated from these aggregates.
+
+    Attributes:
+        - user_freqs: Frequency of COVID posts of each user, in the same order as the users
+        - user_pops: Popularity ratio of COVID posts of each user who isn't ignored, in the same
+        order as the users
+        - user_all_pop_avg: user_all_pop_avg[user] = Average popularity of all the user's posts
+        - user_date_covid_pop_avg: user_date_covid_pop_avg[user][date] = Average popularity of
+        COVID-posts by the user on that date
+        - dates: Sorted dates that any of the users posted on (datetime64[D])
+        - date_covid_count: date_covid_count[i] = Number of COVID posts by the users on dates[i]
+        - date_all_count: date_all_count[i] = Number of posts by the users on dates[i]
+
+    Representation Invariants:
+        - len(self.dates) == len(self.date_covid_count) == len(self.date_all_count)
+    """
+    user_freqs: list[UserFloat]
+    user_pops: list[UserFloat]
+    user_all_pop_avg: dict[str, float]
+    user_date_covid_pop_avg: dict[str, dict[str, float]]
+    dates: np.ndarray
+    date_covid_count: np.ndarray
+    date_all_count: np.ndarray
+
+
+# Directory of the user x day aggregate cube (see UserDayCube)
+CUBE_DIR = f'{DATA_DIR}/cache/cube'
+
+# Arrays of the cube, each stored as <name>.npy in the cube directory
+CUBE_ARRAYS = ['users', 'signatures', 'indptr', 'days', 'count', 'covid', 'pop', 'covid_pop',
+               'repost']
+
+# Daily totals stored in the cube (see UserDays)
+CUBE_CHANNELS = ['count', 'covid', 'pop', 'covid_pop', 'repost']
+
+
+class UserDayCube:
+    """
+    Daily totals (see UserDays) of every aggregated user, stored as a sparse user x day matrix in
+    compressed sparse row format: the totals of users[u] are at the entries indptr[u] to
+    indptr[u + 1] of each channel. Every metric of the analysis is derived from the cube with array
+    operations, so adding a metric or a sample doesn't need another pass over the postings.
+
+    The cube is saved as .npy files in CUBE_DIR and memory-mapped when loaded. It also stores the
+    signature of each user's processed tweets file, so that only users whose postings changed are
+    aggregated again (see load_user_day_cube).
+
+    Attributes:
+        - users: User screen names (one row per user)
+        - signatures: signatures[u] = (Modified time in ns, size) of users[u]'s tweets file
+        - indptr: Row pointers, the entries of users[u] are indptr[u]:indptr[u + 1]
+        - days: days[e] = Day of entry e (days since 1970-01-01)
+        - count, covid, pop, covid_pop, repost: Daily totals of entry e (see UserDays)
+
+    Representation Invariants:
+        - len(self.users) == len(self.signatures) == len(self.indptr) - 1
+        - self.indptr[0] == 0 and self.indptr[-1] == len(self.days)
+        - all(len(getattr(self, c)) == len(self.days) for c in CUBE_CHANNELS)
+        - The days of every row are sorted and distinct
+    """
+    users: np.ndarray
+    signatures: np.ndarray
+    indptr: np.ndarray
+    days: np.ndarray
+    count: np.ndarray
+    covid: np.ndarray
+    pop: np.ndarray
+    covid_pop: np.ndarray
+    repost: np.ndarray
+
+    # _rows[user] = Row of the user
+    _rows: dict[str, int]
+
+    def __init__(self, users: np.ndarray, signatures: np.ndarray, indptr: np.ndarray,
+                 days: np.ndarray, count: np.ndarray, covid: np.ndarray, pop: np.ndarray,
+                 covid_pop: np.ndarray, repost: np.ndarray) -> None:
+        self.users = users
+        self.signatures = signatures
+        self.indptr = indptr
+        self.days = days
+        self.count = count
+        self.covid = covid
+        self.pop = pop
+        self.covid_pop = covid_pop
+        self.repost = repost
+        self._rows = {u: i for i, u in enumerate(users.tolist())}
+
+    @staticmethod
+    def from_user_days(users: list[str], signatures: list[tuple[int, int]],
+                       user_days: list[UserDays]) -> 'UserDayCube':
+        """
+        Build a cube from the daily totals of each user
+
+        :param users: User screen names
+        :param signatures: Signatures of the users' tweets files
+        :param user_days: Daily totals of each user
+        :return: Cube
+        """
+        epoch = np.datetime64('1970-01-01', 'D')
+        return UserDayCube(
+            np.array(users, str), np.array(signatures, np.int64).reshape(-1, 2),
+            np.cumsum([0] + [len(d.days) for d in user_days], dtype=np.int64),
+            (np.concatenate([np.zeros(0, 'datetime64[D]')] + [d.days for d in user_days]) - epoch)
+            .astype(np.int32),
+            *[np.concatenate([np.zeros(0, np.int64)] + [getattr(d, c) for d in user_days])
+              for c in CUBE_CHANNELS])
+
+    @staticmethod
+    def concat(cubes: list['UserDayCube']) -> 'UserDayCube':
+        """
+        Stack the rows of many cubes
+
+        Preconditions:
+            - cubes != []
+            - No user is in more than one of the cubes
+
+        :param cubes: Cubes
+        :return: Cube with the rows of every cube in order
+        """
+        offsets = np.cumsum([0] + [len(c.days) for c in cubes], dtype=np.int64)
+        return UserDayCube(
+            np.concatenate([c.users for c in cubes]),
+            np.concatenate([c.signatures for c in cubes]),
+            np.concatenate([[0]] + [c.indptr[1:] + o for c, o in zip(cubes, offsets)])
+            .astype(np.int64),
+            *[np.concatenate([getattr(c, a) for c in cubes]) for a in ['days'] + CUBE_CHANNELS])
+
+    def save(self, directory: str) -> None:
+        """
+        Save the cube as .npy files. The files are written to a temporary directory first, so a
+        cube that is being read is never partly overwritten.
+
+        :param directory: Cube directory
+        :return: None
+        """
+        tmp = directory + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        Path(tmp).mkdir(parents=True)
+        for name in CUBE_ARRAYS:
+            np.save(os.path.join(tmp, f'{name}.npy'), getattr(self, name))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp, directory)
+
+    @staticmethod
+    def load(directory: str) -> 'UserDayCube':
+        """
+        Load a saved cube with every array memory-mapped
+
+        :param directory: Cube directory
+        :return: Cube
+        """
+        return UserDayCube(*[np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                             for name in CUBE_ARRAYS])
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def __contains__(self, user: str) -> bool:
+        return user in self._rows
+
+    def rows(self, users: list[str]) -> np.ndarray:
+        """
+        Get the rows of users
+
+        Preconditions:
+            - all(u in self for u in users)
+
+        :param users: User screen names
+        :return: Rows in the same order
+        """
+        return np.array([self._rows[u] for u in users], np.int64)
+
+    def take(self, rows: np.ndarray) -> 'UserDayCube':
+        """
+        Gather rows into a new in-memory cube (rows can repeat)
+
+        :param rows: Rows
+        :return: Cube with the selected rows in order
+        """
+        lengths = self.indptr[rows + 1] - self.indptr[rows]
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        entries = np.repeat(self.indptr[rows] - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return UserDayCube(self.users[rows], self.signatures[rows], indptr,
+                           *[np.asarray(getattr(self, a))[entries]
+                             for a in ['days'] + CUBE_CHANNELS])
+
+    def row_sums(self, channel: str) -> np.ndarray:
+        """
+        Sum a channel over all days of each row
+
+        :param channel: Channel name (one of CUBE_CHANNELS)
+        :return: Sum of each row (int64, exact)
+        """
+        cum = np.concatenate([[0], np.cumsum(getattr(self, channel), dtype=np.int64)])
+        return cum[self.indptr[1:]] - cum[self.indptr[:-1]]
+
+    def matrix(self, channel: str, start: str, end: str) -> np.ndarray:
+        """
+        Expand a channel to a dense user x day matrix over a date range
+
+        :param channel: Channel name (one of CUBE_CHANNELS)
+        :param start: First date ("YYYY-MM-DD")
+        :param end: End date, exclusive ("YYYY-MM-DD")
+        :return: matrix[u, i] = Total of users[u] on the i-th day since start (0 if no postings)
+        """
+        first = (np.datetime64(start, 'D') - np.datetime64('1970-01-01', 'D')).astype(np.int64)
+        n = (np.datetime64(end, 'D') - np.datetime64(start, 'D')).astype(np.int64)
+        out = np.zeros((len(self), n), np.int64)
+        row = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        day = np.asarray(self.days, np.int64) - first
+        in_range = (day >= 0) & (day < n)
+        out[row[in_range], day[in_range]] = np.asarray(getattr(self, channel))[in_range]
+        return out
+
+    def aggregate(self, users: list[str]) -> SampleAggregate:
+        """
+        Calculate the per-user results and daily totals of a list of users (see
+        Sample.calculate_sample_data for the definitions) with array operations.
+
+        Building the cube requires parsing every user's tweets file, but once the users are in the
+        cube, only their daily totals are read, so this doesn't loop over any tweets.
+
+        Preconditions:
+            - all(u in self for u in users)
+
+        :param users: User screen names
+        :return: Aggregated results
+        """
+        sub = self.take(self.rows(users))
+        num_all, num_covid = sub.row_sums('count').tolist(), sub.row_sums('covid').tolist()
+        sum_pop, sum_covid_pop = sub.row_sums('pop').tolist(), sub.row_sums('covid_pop').tolist()
+
+        # Average popularity of the COVID posts on every day with COVID posts
+        posted = sub.covid > 0
+        posted_end = np.concatenate([[0], np.cumsum(posted)])[sub.indptr].tolist()
+        dates = np.datetime_as_string(sub.days[posted].astype('datetime64[D]')).tolist()
+        pop_avg = (sub.covid_pop[posted] / sub.covid[posted]).tolist()
+
+        frequency = []
+        popularity = []
+        user_all_pop_avg = {}
+        user_date_covid_pop_avg = {}
+        for i, u in enumerate(users):
+            # To prevent divide by zero, ignore people who didn't post at all
+            if num_all[i] == 0:
+                frequency.append(UserFloat(u, 0))
+                continue
+            # Calculate the frequency of COVID-related tweets
+            frequency.append(UserFloat(u, num_covid[i] / num_all[i]))
+
+            # Calculate covid popularity by date
+            user_date_covid_pop_avg[u] = dict(zip(dates[posted_end[i]:posted_end[i + 1]],
+                                                  pop_avg[posted_end[i]:posted_end[i + 1]]))
+
+            # Calculate total popularity ratio for a user
+            # To prevent divide by zero, ignore everyone who didn't post about covid
+            if num_covid[i] == 0:
+                continue
+            # Get the average popularity for COVID-related tweets and all tweets
+            covid_pop_avg = sum_covid_pop[i] / num_covid[i]
+            all_pop_avg = sum_pop[i] / num_all[i]
+            user_all_pop_avg[u] = all_pop_avg
+            # To prevent divide by zero, ignore everyone who literally have no likes on any post
+            if all_pop_avg == 0:
+                continue
+            # Get the relative popularity
+            popularity.append(UserFloat(u, covid_pop_avg / all_pop_avg))
+
+        # Group the daily totals of every user by date (ignoring days with only reposts)
+        original = sub.count > 0
+        unique, inverse = np.unique(sub.days[original], return_inverse=True)
+        return SampleAggregate(
+            frequency, popularity, user_all_pop_avg, user_date_covid_pop_avg,
+            unique.astype('datetime64[D]'),
+            np.bincount(inverse, sub.covid[original], len(unique)).astype(np.int64),
+            np.bincount(inverse, sub.count[original], len(unique)).astype(np.int64))
+
+
+def _aggregate_cube_chunk(users: list[str]) -> UserDayCube:
+    """
+    Load and reduce the postings of a chunk of users to a cube (run in worker processes)
+
+    :param users: User screen names
+    :return: Cube of these users
+    """
+    return UserDayCube.from_user_days(users, [tweets_signature(u) for u in users],
+                                      [aggregate_user_days(load_tweet_arrays(u)) for u in users])
+
+
+def load_user_day_cube(users: list[str], processes: Optional[int] = None,
+                       chunk_size: int = 50) -> UserDayCube:
+    """
+    Load the user x day aggregate cube, and make sure that it is up to date for the given users.
+    Users that aren't in the cube, or whose tweets files changed since they were aggregated, are
+    aggregated by a pool of worker processes and the cube is saved again.
+
+    :param users: Users that need to be in the cube
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :param chunk_size: Number of users aggregated by each worker task
+    :return: Cube (users that were in the cube before are kept)
+    """
+    cube = UserDayCube.from_user_days([], [], [])
+    if os.path.isfile(f'{CUBE_DIR}/users.npy'):
+        cube = UserDayCube.load(CUBE_DIR)
+
+    # Find users that are missing or stale. Users in more than one sample are only aggregated
+    # once, since the workers don't share data_cache with each other or with this process.
+    stale = set()
+    for u in dict.fromkeys(users):
+        sig = tweets_signature(u)
+        if u not in cube or sig is None or \
+                tuple(cube.signatures[cube.rows([u])[0]].tolist()) != sig:
+            stale.add(u)
+    if len(stale) == 0:
+        return cube
+
+    debug(f'Aggregating {len(stale)} users into the user x day cube...')
+    todo = list(stale)
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    with multiprocessing.Pool(min(processes or os.cpu_count(), len(chunks)),
+                              use_packed_data, (packed_data_file(),)) as pool:
+        parts = pool.map(_aggregate_cube_chunk, chunks)
+
+    keep = np.array([i for i, u in enumerate(cube.users.tolist()) if u not in stale], np.int64)
+    cube = UserDayCube.concat([cube.take(keep)] + parts)
+    cube.save(CUBE_DIR)
+    debug(f'- Done, the cube has {len(cube)} users and {len(cube.days)} entries.')
+    return cube
+
+
+# Directory of the sample cache, which stores the calculated data of samples (see Sample)
+SAMPLE_CACHE_DIR = f'{DATA_DIR}/cache/samples'
+
+
+def _aggregation_code_version() -> str:
+    """
+    Get a hash of the source code (and constants) that calculates sample data, so that cached
+    samples are recalculated whenever that code changes
+
+    :return: Hash
+    """
+    code = [load_tweet_arrays, aggregate_user_days, UserDayCube.aggregate,
+            Sample.calculate_sample_data, Sample.calculate_change_data,
+            Sample.calculate_user_date_prs, Sample.save, Sample.load, map_to_dates_array,
+            filter_days_avg_array]
+    source = ''.join(inspect.getsource(c) for c in code) + repr(POSTINGS_SINCE)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def sample_cache_file(name: str, users: list[str], start: str = ANALYSIS_START,
+                      end: str = ANALYSIS_END, window: int = CHANGE_WINDOW) -> str:
+    """
+    Get the sample cache file of a sample. The file name is the sample name, a fingerprint of the
+    analysis parameters (see sample_cache_prefix), and a fingerprint of the user list, the
+    signatures (modified time and size) of the users' processed tweets, and the version of the
+    code that calculates sample data.
+
+    :param name: Sample name
+    :param users: Users in the sample
+    :param start: First date of the change analysis
+    :param end: End date of the change analysis
+    :param window: Number of previous days in the moving average of the popularity ratio
+    :return: Path of the cache file (which might not exist)
+    """
+    key = json_stringify([_aggregation_code_version(), users, start, end, window,
+                          [tweets_signature(u) for u in users]])
+    return f'{sample_cache_prefix(name, start, end, window)}' \
+           f'{hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]}.npz'
+
+
+def sample_cache_prefix(name: str, start: str, end: str, window: int) -> str:
+    """
+    Get the common prefix of the sample cache files of a sample with the same analysis
+    parameters. When a sample is saved, the other files with this prefix are out of date, while
+    the files of other parameters are kept.
+
+    :param name: Sample name
+    :param start: First date of the change analysis
+    :param end: End date of the change analysis
+    :param window: Number of previous days in the moving average of the popularity ratio
+    :return: Path prefix of the cache files
+    """
+    params = hashlib.sha1(json_stringify([start, end, window]).encode('utf-8')).hexdigest()[:8]
+    return f'{SAMPLE_CACHE_DIR}/{name}-{params}-'
+
+
 class Sample:
     """
     A sample of many users, containing statistical data that will be used in graphs.
 
+    The calculated data is saved in the sample cache (see sample_cache_file), and later samples
+    with the same users, user data, and analysis parameters are loaded from the cache instead of
+    being calculated again.
+
     Attributes:
         - name: Sample name
         - users: List of user screen names in this sample
@@ -57,13 +528,21 @@ class Sample:
         - user_date_covid_pop_avg: Average popularity of COVID tweets by a specific user on a date
         (user_covid_tweets_pop[user][date] = Average popularity of COVID-posts by {user} on {date})
         - date_covid_freq: Total COVID-tweets frequency on a specific date for all users.
-        - dates: dates[i] = The i-th day since the first tweet
+        - start: First date of the change analysis ("YYYY-MM-DD")
+        - end: End date of the change analysis, exclusive ("YYYY-MM-DD")
+        - window: Number of previous days included in the moving average of date_pops
+        - dates: dates[i] = The i-th day since the start date
+        - user_date_prs: user_date_prs[u, i] = Popularity ratio of COVID posts by self.users[u] on
+        dates[i], or NaN if they didn't post about COVID on that day
         - date_freqs: date_freqs[i] = COVID frequency of all posts from all sampled users on date[i]
         - date_pops: date_pops[i] = Average pop-ratio of all posts from all sampled users on date[i]
 
     Representation Invariants:
         - self.name != ''
         - all(name != '' for name in self.users)
+        - self.start < self.end
+        - self.window >= 0
+        - self.user_date_prs.shape == (len(self.users), len(self.dates))
     """
     name: str
     users: list[str]
@@ -76,20 +555,44 @@ class Sample:
     user_date_covid_pop_avg: dict[str, dict[str, float]]
 
     date_covid_freq: dict[str, float]
-    # dates[i] = The i-th day since the first tweet
+
+    start: str
+    end: str
+    window: int
+    # dates[i] = The i-th day since the start date
     dates: list[datetime]
+    # user_date_prs[u, i] = Popularity ratio of COVID posts by users[u] on dates[i] (or NaN)
+    user_date_prs: np.ndarray
     # date_freqs[i] = COVID frequency of all posts from all users in this sample on date[i]
     date_freqs: list[float]
     # date_pops[i] = Average popularity ratio of all posts from all users in this sample on date[i]
     date_pops: list[float]
 
-    def __init__(self, name: str, users: list[str]) -> None:
+    def __init__(self, name: str, users: list[str], start: str = ANALYSIS_START,
+                 end: str = ANALYSIS_END, window: int = CHANGE_WINDOW,
+                 aggregate: Optional['SampleAggregate'] = None, cache: bool = True) -> None:
         self.name = name
         self.users = users
-        self.calculate_sample_data()
+        self.start = start
+        self.end = end
+        self.window = window
+
+        # Load from the sample cache if the users, their data, and our code haven't changed
+        file = sample_cache_file(name, users, start, end, window)
+        if cache and os.path.isfile(file):
+            debug(f'Loading {name} from the sample cache...')
+            self.load(file)
+            return
+
+        self.calculate_sample_data(aggregate)
         self.calculate_change_data()
+        if cache:
+            prefix = Path(sample_cache_prefix(name, start, end, window))
+            for old in prefix.parent.glob(f'{prefix.name}*.npz'):
+                old.unlink()
+            self.save(file)
 
-    def calculate_sample_data(self) -> None:
+    def calculate_sample_data(self, aggregate: Optional['SampleAggregate'] = None) -> None:
         """
         This function loads and calculates the frequency that a list of user posts about COVID, and
         also calculates their relative popularity of COVID posts.
@@ -110,162 +613,272 @@ class Sample:
         To prevent divide-by-zero, we ignored everyone who didn't post about covid and who didn't
         post at all.
 
+        The per-user results are calculated from the user x day aggregate cube (see UserDayCube),
+        so the postings are only read for users that aren't in the cube yet.
+
         Preconditions:
-          - Downloaded tweets data are sorted by date
+          - aggregate is None or aggregate is the result of cube.aggregate(self.users)
+
+        :param aggregate: Aggregated results of this sample's users, or None to calculate them
+        :return: None
         """
         debug(f'Calculating sample tweets data for {self.name}...')
-        popularity = []
-        frequency = []
-        date_covid_count = {}
-        date_all_count = {}
-        self.user_all_pop_avg = {}
-        self.user_date_covid_pop_avg = {}
-        for i in range(len(self.users)):
-            u = self.users[i]
-
-            # Show progress
-            if i != 0 and i % 100 == 0:
-                debug(f'- Calculated {i} users.')
-
-            # Load processed tweet
-            tweets = load_tweets(u)
-            # Ignore retweets, and ignore tweets that are earlier than the start of COVID
-            tweets = [t for t in tweets if not t.repost and t.date > '2020-01-01T01:01:01']
-            # Filter covid tweets
-            covid = [t for t in tweets if t.covid_related]
-
-            # To prevent divide by zero, ignore people who didn't post at all
-            if len(tweets) == 0:
-                frequency.append(UserFloat(u, 0))
-                continue
-            # Calculate the frequency of COVID-related tweets
-            frequency.append(UserFloat(u, len(covid) / len(tweets)))
-
-            # Calculate date fields
-            # Assume tweets are sorted
-            # tweets.sort(key=lambda x: x.date)
-            # Calculate popularity by date
-            date_cp_sum = {}
-            date_cp_count = {}
-            for t in tweets:
-                d = t.date[:10]
-
-                # For covid popularity on date
-                if t.covid_related:
-                    if d not in date_cp_sum:
-                        date_cp_sum[d] = 0
-                        date_cp_count[d] = 0
-                    date_cp_sum[d] += t.popularity
-                    date_cp_count[d] += 1
-
-                # For frequency on date
-                if d not in date_covid_count:
-                    date_covid_count[d] = 0
-                    date_all_count[d] = 0
-                if t.covid_related:
-                    date_covid_count[d] += 1
-                date_all_count[d] += 1
-
-            self.user_date_covid_pop_avg[u] = \
-                {date: date_cp_sum[date] / date_cp_count[date] for date in date_cp_sum}
-
-            # Calculate total popularity ratio for a user
-            # To prevent divide by zero, ignore everyone who didn't post about covid
-            if len(covid) == 0:
-                continue
-            # Get the average popularity for COVID-related tweets
-            covid_pop_avg = sum(tweet.popularity for tweet in covid) / len(covid)
-            all_pop_avg = sum(tweet.popularity for tweet in tweets) / len(tweets)
-            # Save global_avg
-            self.user_all_pop_avg[u] = all_pop_avg
-            # To prevent divide by zero, ignore everyone who literally have no likes on any post
-            if all_pop_avg == 0:
-                continue
-            # Get the relative popularity
-            popularity.append(UserFloat(u, covid_pop_avg / all_pop_avg))
+        if aggregate is None:
+            aggregate = load_user_day_cube(self.users).aggregate(self.users)
+        self.user_all_pop_avg = aggregate.user_all_pop_avg
+        self.user_date_covid_pop_avg = aggregate.user_date_covid_pop_avg
 
         # Calculate frequency on date
-        self.date_covid_freq = {date: date_covid_count[date] / date_all_count[date] for date in
-                                date_covid_count}
+        self.date_covid_freq = dict(zip(
+            np.datetime_as_string(aggregate.dates).tolist(),
+            (aggregate.date_covid_count / aggregate.date_all_count).tolist()))
 
         # Sort by relative popularity or frequency
-        popularity.sort(key=lambda x: x.data, reverse=True)
-        frequency.sort(key=lambda x: x.data, reverse=True)
-
-        # Assign to sample
-        self.user_freqs = frequency
-        self.user_pops = popularity
+        self.user_freqs = sorted(aggregate.user_freqs, key=lambda x: x.data, reverse=True)
+        self.user_pops = sorted(aggregate.user_pops, key=lambda x: x.data, reverse=True)
         debug('- Done.')
 
     def calculate_change_data(self) -> None:
         """
         This function calculates self.date_freqs and self.date_pops, which are lists that stores the
-        frequencies and popularity ratios on each date since the first tweet. This calculation
+        frequencies and popularity ratios on each date since the start date. This calculation
         ignores users, but instead combines the tweets of the entire sample in the calculation.
 
+        The popularity ratio on a date is averaged over the COVID posting days of every user in a
+        window that covers that date and self.window days before it. The popularity ratios are
+        stored in a user x day matrix, and the window sums are calculated by differencing
+        cumulative sums, instead of summing the entire window again for every date.
+
         More details about the calculations can be found in the report, or report_document.md
 
         Preconditions:
-          - len(self.tweets) > 0
-          - self.tweets != None
+          - self.calculate_sample_data() has been called
 
         :return: None
         """
-        self.dates = []
-        self.date_pops = []
-
-        # Average popularity ratio results over 7 days
-        seven_days_user_prs = []
-
-        # Loop through all dates from the start of COVID to when the data is obtained
-        for (ds, dt) in daterange('2020-01-01', '2021-11-25'):
-            self.dates.append(dt)
-
-            # Calculate date covid popularity ratio
-            users_posted_today = [u for u in self.users if u in self.user_date_covid_pop_avg
-                                  and ds in self.user_date_covid_pop_avg[u]]
-            if len(users_posted_today) == 0:
-                seven_days_user_prs.append([])
-            else:
-                user_prs = [self.user_date_covid_pop_avg[u][ds] / self.user_all_pop_avg[u]
-                            for u in users_posted_today if self.user_all_pop_avg[u] != 0]
-                seven_days_user_prs.append(user_prs)
-
-            # Average over seven days
-            # python_ta thinks user_prs is being shadowed here but it's not because the other
-            # instance is stuck in the else statement above
-            # python_ta also thinks that user_prs is possibly not defined here
-            # but it's in a comprehension so it is
-            seven_days_count = sum(len(user_prs) for user_prs in seven_days_user_prs)
-            if seven_days_count == 0:
-                pops_i = 1
-            else:
-                user_pop_ratio_sum = sum(sum(user_prs) for user_prs in seven_days_user_prs)
-                pops_i = user_pop_ratio_sum / seven_days_count
-
-            # More than seven days, remove one
-            if len(seven_days_user_prs) > 7:
-                seven_days_user_prs.pop(0)
-
-            self.date_pops.append(pops_i)
+        self.calculate_user_date_prs()
+        n = len(self.dates)
+
+        # Sum the ratios and the number of users who posted on each day, then sum them over the
+        # window with cumulative sums: window_sum[i] = cumsum[i] - cumsum[i - window - 1]
+        posted = ~np.isnan(self.user_date_prs)
+        cum_prs = np.concatenate([[0], np.cumsum(np.where(posted, self.user_date_prs, 0).sum(0))])
+        cum_count = np.concatenate([[0], np.cumsum(posted.sum(0))])
+        window_start = np.maximum(np.arange(n) - self.window, 0)
+        window_prs = cum_prs[1:] - cum_prs[window_start]
+        window_count = cum_count[1:] - cum_count[window_start]
+
+        # The ratio is 1 when no one posted during the window
+        self.date_pops = np.where(window_count > 0, window_prs / np.maximum(window_count, 1), 1) \
+            .tolist()
 
         # Date frequencies
-        self.date_freqs = map_to_dates(self.date_covid_freq,
-                                       [x.isoformat()[:10] for x in self.dates])
-        self.date_freqs = filter_days_avg(self.date_freqs, 3)
+        self.date_freqs = filter_days_avg_array(map_to_dates_array(
+            self.date_covid_freq, [x.isoformat()[:10] for x in self.dates]), 3).tolist()
+
+    def calculate_user_date_prs(self) -> None:
+        """
+        Calculate self.dates and the popularity ratio matrix self.user_date_prs, where
+        user_date_prs[u, i] = Average popularity of COVID posts by u on dates[i] / Average
+        popularity of all posts by u
+
+        Preconditions:
+          - self.calculate_sample_data() has been called
+
+        :return: None
+        """
+        self.dates = [dt for _, dt in daterange(self.start, self.end)]
+        start = np.datetime64(self.start, 'D')
+        n = len(self.dates)
+
+        self.user_date_prs = np.full((len(self.users), n), np.nan)
+        for i, u in enumerate(self.users):
+            if u not in self.user_date_covid_pop_avg or self.user_all_pop_avg.get(u, 0) == 0:
+                continue
+            pop_avg = self.user_date_covid_pop_avg[u]
+            days = (np.array(list(pop_avg.keys()), 'datetime64[D]') - start).astype(np.int64)
+            in_range = (days >= 0) & (days < n)
+            self.user_date_prs[i, days[in_range]] = \
+                np.array(list(pop_avg.values()))[in_range] / self.user_all_pop_avg[u]
+
+    def bootstrap_date_pops(self, resamples: int = BOOTSTRAP_RESAMPLES,
+                            confidence: float = CONFIDENCE) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Calculate a bootstrap confidence band of self.date_pops by resampling the users of this
+        sample. date_pops[i] is the sum of the users' popularity ratios in the window of day i
+        divided by the number of their COVID posting days in that window, so each resample is a
+        weighted sum of the users' window sums (see bootstrap_curve).
+
+        Preconditions:
+          - self.calculate_change_data() has been called
+
+        :param resamples: Number of resamples
+        :param confidence: Confidence level
+        :return: Lower and upper bounds of date_pops on each date
+        """
+        posted = ~np.isnan(self.user_date_prs)
+        window_start = np.maximum(np.arange(len(self.dates)) - self.window, 0)
+
+        def window_sums(m: np.ndarray) -> np.ndarray:
+            cum = np.concatenate([np.zeros((len(m), 1)), np.cumsum(m, axis=1)], axis=1)
+            return cum[:, 1:] - cum[:, window_start]
+
+        return bootstrap_curve(window_sums(np.where(posted, self.user_date_prs, 0)),
+                               window_sums(posted), resamples, confidence, default=1)
+
+    def bootstrap_date_freqs(self, resamples: int = BOOTSTRAP_RESAMPLES,
+                             confidence: float = CONFIDENCE) -> tuple[list[float], list[float]]:
+        """
+        Calculate a bootstrap confidence band of self.date_freqs by resampling the users of this
+        sample, using their daily post counts in the user x day aggregate cube. The bounds are
+        smoothed over 3 days like date_freqs.
+
+        :param resamples: Number of resamples
+        :param confidence: Confidence level
+        :return: Lower and upper bounds of date_freqs on each date
+        """
+        cube = load_user_day_cube(self.users)
+        sub = cube.take(cube.rows(self.users))
+        low, high = bootstrap_curve(sub.matrix('covid', self.start, self.end),
+                                    sub.matrix('count', self.start, self.end),
+                                    resamples, confidence)
+        low, high = filter_days_avg_array(np.stack([low, high]), 3)
+        return low.tolist(), high.tolist()
+
+    def save(self, file: str) -> None:
+        """
+        Save the calculated data of this sample to a compressed binary (.npz) file. Users are
+        stored once, and everything keyed by user refers to them by index.
+
+        :param file: File path
+        :return: None
+        """
+        index = {u: i for i, u in reversed(list(enumerate(self.users)))}
+        start = np.datetime64('1970-01-01', 'D')
+        covid_pop_avg = [self.user_date_covid_pop_avg.get(u, {}) for u in self.users]
+        arrays = {
+            'users': np.array(self.users, str),
+            'has_covid_pop_avg': np.array([u in self.user_date_covid_pop_avg for u in self.users]),
+            'freq_users': np.array([index[f.name] for f in self.user_freqs], np.int32),
+            'freq_values': np.array([f.data for f in self.user_freqs], float),
+            'pop_users': np.array([index[f.name] for f in self.user_pops], np.int32),
+            'pop_values': np.array([f.data for f in self.user_pops], float),
+            'all_pop_avg_users': np.array([index[u] for u in self.user_all_pop_avg], np.int32),
+            'all_pop_avg_values': np.array(list(self.user_all_pop_avg.values()), float),
+            # Sparse rows (user u's dates are covid_pop_avg_days[indptr[u]:indptr[u + 1]])
+            'covid_pop_avg_indptr': np.cumsum([0] + [len(d) for d in covid_pop_avg]),
+            'covid_pop_avg_days': (np.array([d for ds in covid_pop_avg for d in ds],
+                                            'datetime64[D]') - start).astype(np.int32),
+            'covid_pop_avg_values': np.array([v for ds in covid_pop_avg for v in ds.values()],
+                                             float),
+            'covid_freq_days': (np.array(list(self.date_covid_freq), 'datetime64[D]') - start)
+            .astype(np.int32),
+            'covid_freq_values': np.array(list(self.date_covid_freq.values()), float),
+            'date_freqs': np.array(self.date_freqs, float),
+            'date_pops': np.array(self.date_pops, float)}
+
+        Path(file).parent.mkdir(parents=True, exist_ok=True)
+        with open(file + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(file + '.tmp', file)
+
+    def load(self, file: str) -> None:
+        """
+        Load the calculated data of this sample saved by self.save(file)
 
+        Preconditions:
+          - file is saved by a sample with the same users, start, end, and window
 
-def load_samples() -> list[Sample]:
+        :param file: File path
+        :return: None
+        """
+        def dates(days: np.ndarray) -> list[str]:
+            return np.datetime_as_string(days.astype('datetime64[D]')).tolist()
+
+        with np.load(file) as z:
+            users = z['users'].tolist()
+            self.user_freqs = [UserFloat(users[i], v) for i, v in
+                               zip(z['freq_users'].tolist(), z['freq_values'].tolist())]
+            self.user_pops = [UserFloat(users[i], v) for i, v in
+                              zip(z['pop_users'].tolist(), z['pop_values'].tolist())]
+            self.user_all_pop_avg = dict(zip([users[i] for i in z['all_pop_avg_users'].tolist()],
+                                             z['all_pop_avg_values'].tolist()))
+            # Every z[...] reads and decompresses the array again, so each is only read once
+            indptr, days = z['covid_pop_avg_indptr'].tolist(), dates(z['covid_pop_avg_days'])
+            values = z['covid_pop_avg_values'].tolist()
+            has_covid_pop_avg = z['has_covid_pop_avg'].tolist()
+            self.user_date_covid_pop_avg = {
+                u: dict(zip(days[indptr[i]:indptr[i + 1]], values[indptr[i]:indptr[i + 1]]))
+                for i, u in enumerate(users) if has_covid_pop_avg[i]}
+            self.date_covid_freq = dict(zip(dates(z['covid_freq_days']),
+                                            z['covid_freq_values'].tolist()))
+            self.date_freqs = z['date_freqs'].tolist()
+            self.date_pops = z['date_pops'].tolist()
+        self.calculate_user_date_prs()
+
+
+# Names of the samples, in the order of sample_user_lists
+SAMPLE_NAMES = ['500-pop', '500-rand', 'eng-news']
+
+
+def sample_user_lists(users: UserSample) -> list[list[str]]:
+    """
+    Get the users of every sample
+
+    :param users: Selected user sample
+    :return: Screen names of the users of each sample in SAMPLE_NAMES
+    """
+    return [[u.username for u in users.most_popular], [u.username for u in users.random],
+            list(users.english_news)]
+
+
+def load_cached_samples() -> list[Sample]:
+    """
+    Load the samples that are in the sample cache and up to date. Unlike load_samples, nothing is
+    calculated or written, so this is safe to call while serving the report. Samples that aren't
+    cached are left out.
+
+    :return: Cached samples
+    """
+    samples = []
+    for name, users in zip(SAMPLE_NAMES, sample_user_lists(load_user_sample())):
+        # A sample whose cache file exists is loaded from it, and never calculated or saved
+        if os.path.isfile(sample_cache_file(name, users)):
+            samples.append(Sample(name, users))
+        else:
+            debug(f'{name} is not in the sample cache, run report_all to calculate it.')
+    return samples
+
+
+def load_samples(processes: Optional[int] = None, chunk_size: int = 50,
+                 cache: bool = True) -> list[Sample]:
     """
     Load samples, and report demographics
 
+    Every sample is calculated from the user x day aggregate cube. Users that aren't in the cube
+    yet (or whose postings changed) are split into chunks and added to the cube by a pool of
+    worker processes. Samples in the sample cache are loaded without aggregating them again.
+
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :param chunk_size: Number of users aggregated by each worker task
+    :param cache: Whether to use the sample cache (see Sample)
     :return: Samples
     """
     # Load sample, convert format
     users = load_user_sample()
-    samples = [Sample('500-pop', [u.username for u in users.most_popular]),
-               Sample('500-rand', [u.username for u in users.random]),
-               Sample('eng-news', list(users.english_news))]
+    names = SAMPLE_NAMES
+    sample_users = sample_user_lists(users)
+
+    # Aggregate the samples that aren't cached from the cube
+    cached = [cache and os.path.isfile(sample_cache_file(n, u))
+              for n, u in zip(names, sample_users)]
+    cube = None
+    if not all(cached):
+        cube = load_user_day_cube([u for us, c in zip(sample_users, cached) if not c for u in us],
+                                  processes, chunk_size)
+
+    samples = [Sample(name, u, cache=cache, aggregate=None if c else cube.aggregate(u))
+               for name, u, c in zip(names, sample_users, cached)]
 
     # Report demographics
     keys = ['en', 'zh', 'ja']
@@ -378,7 +991,9 @@ def graph_histogram(x: list[float], path: str, title: str, freq: bool, clear_out
 
 
 def graph_line_plot(x: list[datetime], y: Union[list[float], list[list[float]]], path: str,
-                    title: str, freq: bool, n: int = 0, labels: Optional[list[str]] = None) -> None:
+                    title: str, freq: bool, n: int = 0, labels: Optional[list[str]] = None,
+                    band: Optional[tuple[list[float], list[float]]] = None,
+                    covid_cases: Optional[list[float]] = None) -> None:
     """
     Plot a line plot, and reduce noise using an IIR filter
 
@@ -389,11 +1004,17 @@ def graph_line_plot(x: list[datetime], y: Union[list[float], list[list[float]]],
     :param freq: Whether you are graphing frequencies data instead of popularity ratios
     :param title: Title
     :param labels: Labels or none
+    :param band: Lower and upper bounds of a confidence band around a single data line, which
+    are filtered like the line (or None)
+    :param covid_cases: US COVID cases on each date in x, plotted with multiple frequency data
+    lines (or None to download them)
     :return: None
     """
     # Filter
     if n > 0:
         y = scipy.signal.lfilter([1.0 / n] * n, 1, y)
+        if band is not None:
+            band = scipy.signal.lfilter([1.0 / n] * n, 1, band)
 
     border_color = '#5b3300'
 
@@ -428,6 +1049,12 @@ def graph_line_plot(x: list[datetime], y: Union[list[float], list[list[float]]],
             ax.axhline(1, color=border_color)
             ax.set_ylim(0, 2)
 
+        # Confidence band
+        if band is not None:
+            ax.fill_between(x, band[0], band[1], color=border_color, alpha=0.25, linewidth=0,
+                            label=f'{CONFIDENCE * 100:g}% CI')
+            ax.legend()
+
     # Plotting multiple data lines
     else:
         fig.set_size_inches(16, 9)
@@ -440,8 +1067,10 @@ def graph_line_plot(x: list[datetime], y: Union[list[float], list[list[float]]],
 
         # Plotting frequency, add in the COVID cases data
         if freq:
-            c = map_to_dates(get_covid_cases_us(), [d.isoformat()[:10] for d in x])
-            c = filter_days_avg(c, 7)
+            c = covid_cases
+            if c is None:
+                c = map_to_dates(get_covid_cases_us().cases, [d.isoformat()[:10] for d in x])
+            c = filter_days_avg_array(c, 7)
             c = scipy.signal.lfilter([1.0 / n] * n, 1, c)
 
             twin: plt.Axes = ax.twinx()
@@ -470,71 +1099,334 @@ def graph_line_plot(x: list[datetime], y: Union[list[float], list[list[float]]],
     plt.close(fig)
 
 
-def report_histograms(sample: Sample) -> None:
+def graph_lag_plot(lags: list[int], r: list[list[float]], path: str, title: str,
+                   labels: list[str]) -> None:
+    """
+    Plot correlations against lags, with the best lag of each line marked
+
+    :param lags: X axis data, lags in days
+    :param r: Y axis data lines, r[i][j] = correlation of line i at lags[j]
+    :param path: Output image path (should end in .png)
+    :param title: Title
+    :param labels: Labels of the lines
+    :return: None
+    """
+    border_color = '#5b3300'
+
+    # Create fig ax
+    fig: plt.Figure
+    ax: plt.Axes
+    fig, ax = plt.subplots()
+    ax.margins(x=0)
+
+    # Plot
+    ax.set_title(title, color=border_color)
+    ax.axvline(0, color='#DACAA9')
+    ax.axhline(0, color='#DACAA9')
+    for i in range(len(r)):
+        line, = ax.plot(lags, r[i], label=labels[i])
+        y = np.array(r[i], float)
+        if not np.all(np.isnan(y)):
+            best = int(np.nanargmax(y))
+            ax.plot(lags[best], y[best], 'o', color=line.get_color())
+    ax.set_xlabel('Lag (days)', color=border_color)
+    ax.set_ylabel('Correlation', color=border_color)
+    ax.set_ylim(-1, 1)
+    ax.legend()
+
+    # Colors
+    ax.tick_params(color=border_color, labelcolor=border_color)
+    for spine in ax.spines.values():
+        spine.set_edgecolor(border_color)
+
+    # Grid
+    ax.grid(visible=True, axis='both')
+
+    # Save
+    path = Path(os.path.join(REPORT_DIR, path))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(str(path))
+    fig.clf()
+    plt.close(fig)
+
+
+class ChartJob(NamedTuple):
+    """
+    A chart to render. The inputs are only plain data (lists, arrays, strings and numbers), so a
+    job can be sent to a worker process and rendered independently of the others.
+
+    Attributes:
+        - render: Graph function, graph_histogram, graph_line_plot or graph_lag_plot
+        - kwargs: Keyword arguments of the graph function (including the output path)
+
+    Representation Invariants:
+        - 'path' in self.kwargs
+    """
+    render: Callable[..., None]
+    kwargs: dict[str, Any]
+
+
+def _init_chart_worker() -> None:
+    """
+    Initialize a chart rendering worker process: use the non-interactive Agg backend and load
+    the font once for every chart the worker renders
+
+    :return: None
+    """
+    matplotlib.use('Agg')
+    graph_load_font()
+
+
+def _render_chart(job: ChartJob) -> str:
+    """
+    Render a chart job (run in worker processes)
+
+    :param job: Chart job
+    :return: Output path of the chart
+    """
+    job.render(**job.kwargs)
+    return job.kwargs['path']
+
+
+# Manifest of rendered charts, manifest[path] = Fingerprint of the chart's inputs. It's kept with
+# the other caches rather than in the report, so that it isn't published with the report.
+RENDER_MANIFEST = f'{DATA_DIR}/cache/render-manifest.json'
+
+
+def chart_style_version() -> str:
+    """
+    Get a hash of the inputs shared by every chart: the matplotlib version, the font and the code
+    that loads it, and the outlier filter and confidence level used by the graph functions
+
+    :return: Hash
+    """
+    h = hashlib.sha1()
+    h.update(f'{matplotlib.__version__} {CONFIDENCE!r}'.encode('utf-8'))
+    h.update(inspect.getsource(graph_load_font).encode('utf-8'))
+    h.update(inspect.getsource(remove_outliers).encode('utf-8'))
+    with open(os.path.join(RES_DIR, 'iosevka-ss04-regular.ttf'), 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def chart_fingerprint(job: ChartJob, style: str) -> str:
+    """
+    Fingerprint a chart job. The fingerprint covers every input of the chart (the data, title,
+    filter parameters, ...), the source code of the graph function, and the shared style inputs,
+    so two jobs with the same fingerprint render the same image.
+
+    :param job: Chart job
+    :param style: Hash of the shared inputs (see chart_style_version)
+    :return: Fingerprint
+    """
+    def plain(o: Any) -> Any:
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, (list, tuple)):
+            return [plain(v) for v in o]
+        return o
+
+    kwargs = sorted((k, plain(v)) for k, v in job.kwargs.items())
+    key = json_stringify([job.render.__name__, inspect.getsource(job.render), style, kwargs])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def render_charts(jobs: list[ChartJob], processes: Optional[int] = None) -> None:
+    """
+    Render charts in a pool of worker processes. Rendering and PNG encoding are single-threaded in
+    matplotlib, so the charts are rendered in parallel, one chart per task.
+
+    Charts whose fingerprint (see chart_fingerprint) is the same as in the render manifest of the
+    last run, and whose output file still exists, are reused without calling matplotlib.
+
+    :param jobs: Chart jobs
+    :param processes: Number of worker processes (Default: number of CPUs)
+    :return: None
+    """
+    manifest = json.loads(read(RENDER_MANIFEST)) if os.path.isfile(RENDER_MANIFEST) else {}
+    style = chart_style_version()
+    fingerprints = {job.kwargs['path']: chart_fingerprint(job, style) for job in jobs}
+
+    todo = []
+    for job in jobs:
+        path = job.kwargs['path']
+        if manifest.get(path) == fingerprints[path] and \
+                os.path.isfile(os.path.join(REPORT_DIR, path)):
+            debug(f'- Reused {path}')
+        else:
+            todo.append(job)
+
+    # Charts are removed from the manifest until they are rendered again
+    for job in todo:
+        manifest.pop(job.kwargs['path'], None)
+
+    def rendered(p: str) -> None:
+        debug(f'- Rendered {p}')
+        manifest[p] = fingerprints[p]
+        write(RENDER_MANIFEST, json_stringify(manifest, indent=1))
+
+    if processes == 1:
+        for job in todo:
+            rendered(_render_chart(job))
+    elif len(todo) > 0:
+        with multiprocessing.Pool(processes, _init_chart_worker) as pool:
+            for path in pool.imap_unordered(_render_chart, todo):
+                rendered(path)
+    debug(f'Reused {len(jobs) - len(todo)} charts, rendered {len(todo)} charts.')
+
+
+def report_histograms(sample: Sample) -> list[ChartJob]:
     """
     Report histograms of COVID posting frequencies and popularity ratios
 
     :param sample: Sample
-    :return: None
+    :return: Chart jobs (see render_charts)
     """
     x = [f.data for f in sample.user_freqs]
     title = f'COVID-related posting frequency for {sample.name}'
-    graph_histogram(x, f'freq/{sample.name}-hist-outliers.png', title, True, False, 100)
+    jobs = [ChartJob(graph_histogram, dict(x=x, path=f'freq/{sample.name}-hist-outliers.png',
+                                           title=title, freq=True, clear_outliers=False,
+                                           bins=100))]
     x = [p for p in x if p > 0.001]
-    graph_histogram(x, f'freq/{sample.name}-hist.png', title, True, True)
+    jobs.append(ChartJob(graph_histogram, dict(x=x, path=f'freq/{sample.name}-hist.png',
+                                               title=title, freq=True, clear_outliers=True)))
 
     x = [f.data for f in sample.user_pops]
     title = f'Popularity ratio of COVID posts for {sample.name}'
-    graph_histogram(x, f'pop/{sample.name}-hist.png', title, False, True)
+    jobs.append(ChartJob(graph_histogram, dict(x=x, path=f'pop/{sample.name}-hist.png',
+                                               title=title, freq=False, clear_outliers=True)))
+    return jobs
 
 
 def report_stats(samples: list[Sample]) -> None:
     """
-    Report frequencies and popularity ratios' statistics
+    Report frequencies and popularity ratios' statistics, with bootstrap confidence intervals of
+    the mean, median and IQR appended after the point estimates
 
     :param samples: Samples
     :return: None
     """
+    def intervals(x: list[float]) -> StatsIntervals:
+        return bootstrap_statistics(x, BOOTSTRAP_RESAMPLES, CONFIDENCE)
+
     xs = [[d.data for d in s.user_pops] for s in samples]
 
-    table = tabulate_stats([get_statistics(x) for x in xs])
+    table = tabulate_stats([get_statistics(x) for x in xs]) + \
+        tabulate_intervals([intervals(x) for x in xs])
     Reporter('pop/stats-with-outliers.md').table(table, [s.name for s in samples], True)
 
-    table = tabulate_stats([get_statistics(remove_outliers(x)) for x in xs])
+    xs = [remove_outliers(x) for x in xs]
+    table = tabulate_stats([get_statistics(x) for x in xs]) + \
+        tabulate_intervals([intervals(x) for x in xs])
     Reporter('pop/stats.md').table(table, [s.name for s in samples], True)
 
     xs = [[d.data for d in s.user_freqs if d.data > 0.0005] for s in samples]
-    table = tabulate_stats([get_statistics(x) for x in xs], percent=True)
+    table = tabulate_stats([get_statistics(x) for x in xs], percent=True) + \
+        tabulate_intervals([intervals(x) for x in xs], percent=True)
     Reporter('freq/stats.md').table(table, [s.name for s in samples], True)
 
 
-def report_change_different_n(sample: Sample) -> None:
+def report_change_different_n(sample: Sample) -> list[ChartJob]:
     """
     Experiment wth different n values for IIR filter
 
     :param sample: Sample
-    :return: None
+    :return: Chart jobs (see render_charts)
     """
-    for n in [5, 10, 15]:
-        graph_line_plot(sample.dates, sample.date_pops, f'change/n/{n}.png',
-                        f'COVID-posting popularity ratio over time for {sample.name} IIR(n={n})',
-                        False, n)
+    return [ChartJob(graph_line_plot, dict(
+        x=sample.dates, y=sample.date_pops, path=f'change/n/{n}.png',
+        title=f'COVID-posting popularity ratio over time for {sample.name} IIR(n={n})',
+        freq=False, n=n)) for n in [5, 10, 15]]
 
 
-def report_change_graphs(sample: Sample) -> None:
+def report_change_graphs(sample: Sample) -> list[ChartJob]:
     """
     Report COVID-posting popularity ratio vs. time and COVID-posting frequency vs time,
-    both with IIR(10) filter
+    both with IIR(10) filter and bootstrap confidence bands
 
     :param sample: Sample
-    :return: None
+    :return: Chart jobs (see render_charts)
+    """
+    return [ChartJob(graph_line_plot, dict(
+        x=sample.dates, y=sample.date_pops, path=f'change/pop/{sample.name}.png',
+        title=f'COVID-posting popularity ratio over time for {sample.name} IIR(10)',
+        freq=False, n=10, band=sample.bootstrap_date_pops())),
+        ChartJob(graph_line_plot, dict(
+            x=sample.dates, y=sample.date_freqs, path=f'change/freq/{sample.name}.png',
+            title=f'COVID-posting frequency over time for {sample.name} IIR(10)',
+            freq=True, n=10, band=sample.bootstrap_date_freqs()))]
+
+
+def user_lag_correlations(sample: Sample, curve: np.ndarray) -> np.ndarray:
+    """
+    Calculate the lagged correlations between each user's COVID-posting frequency and a curve.
+    The frequencies are calculated from the user x day aggregate cube over 7-day windows, and only
+    users with at least LAG_MIN_COVID_POSTS COVID posts in the analysis range are included.
+
+    :param sample: Sample
+    :param curve: Curve on each date of the sample
+    :return: r[u, MAX_LAG + L] = correlation of the u-th included user at lag L (see
+    lagged_correlation)
+    """
+    cube = load_user_day_cube(sample.users)
+    sub = cube.take(cube.rows(sample.users))
+    covid = sub.matrix('covid', sample.start, sample.end)
+    count = sub.matrix('count', sample.start, sample.end)
+    keep = covid.sum(axis=1) >= LAG_MIN_COVID_POSTS
+    freqs = divide_zeros_array(filter_days_avg_array(covid[keep], 7),
+                               filter_days_avg_array(count[keep], 7))
+    return lagged_correlation(freqs, curve, MAX_LAG)
+
+
+def report_lag_analysis(samples: list[Sample], cases: CasesData) -> list[ChartJob]:
+    """
+    Report the lags between the COVID-posting frequencies and popularity ratios of each sample and
+    the US COVID cases and deaths. A positive lag means that the posting curve follows the cases
+    or deaths curve. For frequencies, the median best lag of the individual users is reported too.
+
+    :param samples: Samples
+    :param cases: US COVID cases and deaths data
+    :return: Chart jobs (see render_charts)
     """
-    graph_line_plot(sample.dates, sample.date_pops, f'change/pop/{sample.name}.png',
-                    f'COVID-posting popularity ratio over time for {sample.name} IIR(10)',
-                    False, 10)
-    graph_line_plot(sample.dates, sample.date_freqs, f'change/freq/{sample.name}.png',
-                    f'COVID-posting frequency over time for {sample.name} IIR(10)',
-                    True, 10)
+    dates = [d.isoformat()[:10] for d in samples[0].dates]
+    curves = {'cases': map_to_dates_array(cases.cases, dates),
+              'deaths': map_to_dates_array(cases.deaths, dates)}
+    lags = list(range(-MAX_LAG, MAX_LAG + 1))
+    headers = [s.name for s in samples]
+
+    def best(r: np.ndarray) -> tuple[str, str]:
+        if np.all(np.isnan(r)):
+            return '-', '-'
+        i = int(np.nanargmax(r))
+        return str(lags[i]), f'{r[i]:.2f}'
+
+    jobs = []
+    for kind, name in [('freq', 'frequency'), ('pop', 'popularity ratio')]:
+        table = []
+        users = []
+        for curve_name, curve in curves.items():
+            r = lagged_correlation([s.date_freqs if kind == 'freq' else s.date_pops
+                                    for s in samples], curve, MAX_LAG)
+            bests = [best(x) for x in r]
+            table += [[f'Best lag vs. {curve_name} (days)'] + [b[0] for b in bests],
+                      [f'r at best lag vs. {curve_name}'] + [b[1] for b in bests],
+                      [f'r at lag 0 vs. {curve_name}'] + [f'{x[MAX_LAG]:.2f}' for x in r]]
+            jobs.append(ChartJob(graph_lag_plot, dict(
+                lags=lags, r=r.tolist(), path=f'lag/{kind}-{curve_name}.png',
+                title=f'Correlation of COVID-posting {name} and US {curve_name} by lag',
+                labels=headers)))
+
+            # The popularity ratios of single users on single days are too sparse for this
+            if kind == 'freq':
+                users = [user_lag_correlations(s, curve) for s in samples]
+                users = [u[~np.all(np.isnan(u), axis=1)] for u in users]
+                table.append([f'Median user lag vs. {curve_name} (days)']
+                             + [f'{np.median(np.nanargmax(u, axis=1)) - MAX_LAG:g}'
+                                if len(u) > 0 else '-' for u in users])
+        if kind == 'freq':
+            table.append(['Users in the user lags'] + [str(len(u)) for u in users])
+        Reporter(f'lag/{kind}.md').table(table, headers, True)
+    return jobs
 
 
 def report_all() -> None:
@@ -557,30 +1449,43 @@ def report_all() -> None:
 
     report_ignored(samples)
     report_stats(samples)
+    jobs = []
     for s in samples:
         report_top_20_tables(s)
-        report_histograms(s)
-        report_change_graphs(s)
-    report_change_different_n(samples[0])
+        jobs += report_histograms(s)
+        jobs += report_change_graphs(s)
+    jobs += report_change_different_n(samples[0])
 
     # python_ta thinks that s is shadowing again but the other instance is in the for loop above
     # or in another comprehension so clearly there is no shadowing
-    graph_line_plot(samples[0].dates, [s.date_pops for s in samples], 'change/comb/pop.png',
-                    'COVID-posting popularity ratio over time for all samples - IIR(10)', False, 10,
-                    labels=[s.name for s in samples])
-    graph_line_plot(samples[0].dates, [s.date_freqs for s in samples], 'change/comb/freq.png',
-                    'COVID-posting frequency over time for all samples - IIR(10)', True, 10,
-                    labels=[s.name for s in samples])
+    jobs.append(ChartJob(graph_line_plot, dict(
+        x=samples[0].dates, y=[s.date_pops for s in samples], path='change/comb/pop.png',
+        title='COVID-posting popularity ratio over time for all samples - IIR(10)', freq=False,
+        n=10, labels=[s.name for s in samples])))
+    # The COVID cases are downloaded here once, instead of in the worker processes
+    cases = get_covid_cases_us()
+    jobs.append(ChartJob(graph_line_plot, dict(
+        x=samples[0].dates, y=[s.date_freqs for s in samples], path='change/comb/freq.png',
+        title='COVID-posting frequency over time for all samples - IIR(10)', freq=True, n=10,
+        labels=[s.name for s in samples],
+        covid_cases=map_to_dates(cases.cases, [d.isoformat()[:10] for d in samples[0].dates]))))
+    jobs += report_lag_analysis(samples, cases)
+
+    debug(f'Rendering {len(jobs)} charts...')
+    render_charts(jobs)
 
 
 if __name__ == '__main__':
     # python_ta.contracts.check_all_contracts()
     python_ta.check_all(config={
-        'extra-imports': ['os.path', 'dataclasses', 'datetime', 'pathlib', 'typing', 'matplotlib',
-                          'matplotlib.dates', 'matplotlib.ticker', 'scipy.signal', 'collect_others',
-                          'processing', 'constants', 'utils'
+        'extra-imports': ['hashlib', 'inspect', 'json', 'multiprocessing', 'os.path', 'shutil',
+                          'dataclasses', 'datetime', 'pathlib', 'typing', 'matplotlib',
+                          'matplotlib.dates', 'matplotlib.ticker', 'numpy',
+                          'scipy.signal', 'collect_others', 'processing', 'constants', 'utils'
                           ],  # the names (strs) of imported modules
-        'allowed-io': ['report_all'],  # the names (strs) of functions that call print/open/input
+        # the names (strs) of functions that call print/open/input
+        'allowed-io': ['report_all', 'Sample.save', 'UserDayCube.save', 'render_charts',
+                       'chart_style_version'],
         'max-line-length': 100,
         'disable': ['R1705', 'C0200', 'E9988', 'E9969', 'R0902', 'R1702', 'R0913']
     }, output='pyta_report.html')